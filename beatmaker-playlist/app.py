@@ -1,9 +1,8 @@
 from quart import Quart, render_template, redirect, request, session, url_for, jsonify, websocket
 from quart_cors import cors
-import asyncio
+import contextlib
 import redis.asyncio as redis
 import logging
-import aiohttp
 import secrets
 from typing import Optional
 import uuid
@@ -11,12 +10,23 @@ import json
 
 import secret_keys
 from beatmaker_playlist import BeatmakerPlaylist, BeatmakerPlaylistResults
+from http_client import SessionPool
+from image_pool import ImagePool
+from jobs import Job, JobQueue
+from progress import ProgressHub
 
 
 app = Quart(__name__)
 app = cors(app, allow_origin=["http://127.0.0.1:8000"], allow_credentials=True)
 app.secret_key = secrets.token_hex(16)
+# Connections shared by every BeatmakerPlaylist, the caches and the rate limiters of the process
+REDIS_MAX_CONNECTIONS = 50
+
 app.client = None
+app.redis = None
+app.image_pool = None
+app.progress_hub = None
+app.job_queue = None
 
 playlist_tasks = {}
 
@@ -24,13 +34,26 @@ playlist_tasks = {}
 @app.before_serving
 async def startup():
     """"""
-    app.client = aiohttp.ClientSession()
+    redis_pool = redis.BlockingConnectionPool(
+        host=secret_keys.REDIS_HOST,
+        port=secret_keys.REDIS_PORT,
+        db=secret_keys.REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+    )
+    app.redis = redis.Redis.from_pool(redis_pool)
+    app.client = SessionPool(redis_client=app.redis)
+    app.image_pool = ImagePool()
+    app.progress_hub = ProgressHub(app.redis)
+    app.job_queue = JobQueue(app.redis)
 
 
 @app.after_serving
 async def close():
     """Before terminating the app, shutdown the needed objects"""
+    await app.progress_hub.close()
     await app.client.close()
+    await app.redis.aclose()
+    app.image_pool.shutdown()
 
 
 @app.route("/")
@@ -43,7 +66,11 @@ async def index():
         user_id = str(uuid.uuid4())
         session["user_id"] = user_id
         playlist_tasks[user_id] = BeatmakerPlaylist(
-            client=app.client, user_id=user_id, faster_tests=secret_keys.FASTER_TESTS
+            client=app.client,
+            user_id=user_id,
+            faster_tests=secret_keys.FASTER_TESTS,
+            image_pool=app.image_pool,
+            redis_client=app.redis,
         )
 
     user_id = session["user_id"]
@@ -119,7 +146,63 @@ async def create_playlist():
     task_id = str(uuid.uuid4())
     user_id = session["user_id"]
     playlist_manager: BeatmakerPlaylist = playlist_tasks.get(user_id)
-    app.add_background_task(playlist_manager.make_playlist, beatmaker_name, task_id)
+    # The playlist is built by a worker process
+    await playlist_manager.update_progress(task_id, 0, "Waiting for an available worker")
+    job = Job(
+        kind="make_playlist",
+        user_id=user_id,
+        task_id=task_id,
+        args={"beatmaker_name": beatmaker_name},
+        credentials=playlist_manager.get_spotify_credentials(),
+        priority=JobQueue.PRIORITY_BUILD,
+    )
+    await app.job_queue.enqueue(job)
+
+    logging.info(f"user_id: {user_id}, task_id: {task_id}")
+    return (
+        jsonify(
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "message": "Task started successfully",
+            }
+        ),
+        202,
+    )
+
+
+@app.route("/refresh_playlist", methods=["POST"])
+async def refresh_playlist():
+    """Endpoint to start the refresh_playlist task"""
+    if "user_id" not in session:
+        logging.info("No session linked to this request")
+        return jsonify({"error": "No session linked to this request"}), 400
+    if "access_token" not in session:
+        logging.info("Not authenticated")
+        return jsonify({"error": "Not authenticated"}), 401
+
+    # Get playlist id from input form
+    form_data = await request.get_json()
+    playlist_id = form_data.get("playlist_id")
+    if not playlist_id:
+        logging.info("No playlist id given")
+        return jsonify({"error": "No playlist id given"}), 400
+
+    # Create task_id
+    task_id = str(uuid.uuid4())
+    user_id = session["user_id"]
+    playlist_manager: BeatmakerPlaylist = playlist_tasks.get(user_id)
+    # The playlist is refreshed by a worker process
+    await playlist_manager.update_progress(task_id, 0, "Waiting for an available worker")
+    job = Job(
+        kind="refresh_playlist",
+        user_id=user_id,
+        task_id=task_id,
+        args={"playlist_id": playlist_id},
+        credentials=playlist_manager.get_spotify_credentials(),
+        priority=JobQueue.PRIORITY_REFRESH,
+    )
+    await app.job_queue.enqueue(job)
 
     logging.info(f"user_id: {user_id}, task_id: {task_id}")
     return (
@@ -156,6 +239,23 @@ async def get_task_result(user_id, task_id):
         return jsonify({"status": "error", "error": str(e)}), 500
 
 
+@app.route("/stats")
+async def get_stats():
+    """Endpoint to retrieve the request, cache and job queue statistics of the application"""
+    if "user_id" not in session or "access_token" not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+
+    playlist_manager: BeatmakerPlaylist = playlist_tasks.get(session["user_id"])
+    return jsonify(
+        {
+            "requests": playlist_manager.get_request_stats(),
+            "caches": playlist_manager.get_cache_stats(),
+            "jobs": await app.job_queue.stats(),
+            "progress": app.progress_hub.stats(),
+        }
+    )
+
+
 @app.websocket("/task-status/<user_id>/<task_id>")
 async def get_task_status(user_id, task_id):
     """
@@ -197,25 +297,23 @@ async def get_task_status(user_id, task_id):
 
         try:
             playlist_manager: BeatmakerPlaylist = playlist_tasks.get(user_id)
-            task_state = await playlist_manager.get_state(task_id)
-
-            while True:
-                try:
-                    task_state = await playlist_manager.get_state(task_id)
-                    # logging.info(f"Task state: {task_state}")
 
-                    await websocket.send(json.dumps(task_state))
+            try:
+                # Current state on connection, then each update as soon as it is published
+                task_states = playlist_manager.watch_state(task_id, app.progress_hub)
+                async with contextlib.aclosing(task_states):
+                    async for task_state in task_states:
+                        # logging.info(f"Task state: {task_state}")
 
-                    if task_state["completed"] or task_state.get("error"):
-                        logging.info("Task completed or error occurred, closing connection")
-                        break
+                        await websocket.send(json.dumps(task_state))
 
-                    await asyncio.sleep(1)
+                        if task_state["completed"] or task_state.get("error"):
+                            logging.info("Task completed or error occurred, closing connection")
+                            break
 
-                except Exception as e:
-                    logging.error(f"Error during WebSocket communication: {e}")
-                    await websocket.send(json.dumps({"error": str(e)}))
-                    break
+            except Exception as e:
+                logging.error(f"Error during WebSocket communication: {e}")
+                await websocket.send(json.dumps({"error": str(e)}))
 
         except Exception as e:
             print(f"WebSocket error: {e}")
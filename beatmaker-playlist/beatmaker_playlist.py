@@ -1,15 +1,35 @@
-import aiohttp
 from dataclasses import dataclass, asdict
+import asyncio
+import contextlib
 import uuid
 import redis.asyncio as redis
 import json
 import logging
+from typing import AsyncIterable, AsyncIterator, Optional
 
-from utils import Match, Playlist
+from http_client import SessionPool
+from image_pool import ImagePool
+from jobs import Checkpoint
+from utils import Match, Playlist, Track
+from pipeline import buffered
+from producer_index import ProducerIndex
+from producer_songs import ProducerSongs, SharedProducerSongs
+from progress import ProgressHub, SongsProgress
 from spotify import Spotify
 from genius import Genius
 import secret_keys
 
+# Store the fields in the task state with the next sequence number of the task, refresh its expiration, and publish
+# the event with the same sequence number, for watchers to drop the events older than the state they read.
+# KEYS: task state. ARGV: ttl, channel, event JSON object, then field and value pairs
+WRITE_TASK_STATE_SCRIPT = """
+local sequence = redis.call('HINCRBY', KEYS[1], 'sequence', 1)
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+redis.call('PUBLISH', ARGV[2], '{"sequence":' .. sequence .. ',' .. string.sub(ARGV[3], 2))
+return sequence
+"""
+
 
 @dataclass
 class BeatmakerPlaylistResults:
@@ -26,14 +46,49 @@ class BeatmakerPlaylistResults:
 class BeatmakerPlaylist:
     """"""
 
-    def __init__(self, client: aiohttp.ClientSession, user_id: str, debug: bool = False, faster_tests: bool = False):
-        """"""
+    QUEUE_SIZE = 100
+    STATE_RESYNC_INTERVAL = 30
+    TASK_STATE_TTL = 3600
+    # Songs progress is reported at most once per interval
+    PROGRESS_INTERVAL = 0.5
+    PROGRESS_DETAILS = ("songs_found", "songs_done", "rate", "eta")
+    PLAYLIST_STATE_TTL = 365 * 24 * 3600
+
+    def __init__(
+        self,
+        client: SessionPool,
+        user_id: str,
+        debug: bool = False,
+        faster_tests: bool = False,
+        image_pool: Optional[ImagePool] = None,
+        redis_client: Optional[redis.Redis] = None,
+        shared_songs: Optional[SharedProducerSongs] = None,
+        producer_index: Optional[ProducerIndex] = None,
+    ):
+        """redis_client, shared_songs and producer_index should be shared by every BeatmakerPlaylist, dedicated ones
+        are created if missing"""
         self.user_id = user_id
-        self.redis_client = redis.Redis(
+        self._client = client
+        self.redis_client = redis_client or redis.Redis(
             host=secret_keys.REDIS_HOST, port=secret_keys.REDIS_PORT, db=secret_keys.REDIS_DB
         )
-        self._spotify: Spotify = Spotify(session=client, debug=debug, faster_tests=faster_tests)
-        self._genius: Genius = Genius(session=client, debug=debug, faster_tests=faster_tests)
+        self._write_task_state_script = self.redis_client.register_script(WRITE_TASK_STATE_SCRIPT)
+        self.shared_songs = shared_songs or SharedProducerSongs(self.redis_client)
+        self.producer_index = producer_index or ProducerIndex(self.redis_client)
+        self._spotify: Spotify = Spotify(
+            session=client,
+            debug=debug,
+            faster_tests=faster_tests,
+            redis_client=self.redis_client,
+            image_pool=image_pool,
+        )
+        self._genius: Genius = Genius(
+            session=client,
+            debug=debug,
+            faster_tests=faster_tests,
+            redis_client=self.redis_client,
+            producer_index=self.producer_index,
+        )
 
     def get_spotify_auth_url(self):
         """"""
@@ -47,30 +102,76 @@ class BeatmakerPlaylist:
         """"""
         return await self._spotify.get_user_profile()
 
+    def get_spotify_credentials(self) -> dict:
+        """Access token response and profile of the user, for a worker to build playlists on their behalf"""
+        return {"access_token_response": self._spotify.access_token_response, "user": self._spotify.user_profile}
+
+    def set_spotify_credentials(self, access_token_response: dict, user: dict) -> None:
+        """"""
+        self._spotify.set_access_token_response(access_token_response)
+        self._spotify.set_user_profile(user)
+
     async def get_spotify_profile_image(self):
         return await self._spotify.get_user_profile_image()
 
+    def get_request_stats(self) -> dict:
+        """Requests of the process to each host, connection pools usage, rate limiters state, coalesced GET
+        requests and image jobs"""
+        return {
+            "hosts": self._client.concurrency_limiter.stats(),
+            "pools": self._client.stats(),
+            "rate_limits": self._client.rate_limiters.stats(),
+            "single_flight": self._client.single_flight.stats(),
+            "images": self._spotify.image_pool.stats(),
+        }
+
+    def get_cache_stats(self) -> dict:
+        """Hit and miss counts of the Genius and Spotify caches"""
+        stats = {}
+        if self._genius.song_cache is not None:
+            stats["genius_song"] = self._genius.song_cache.stats()
+            stats["genius_artist"] = self._genius.artist_cache.stats()
+        if self._spotify.match_cache is not None:
+            stats["spotify_match"] = self._spotify.match_cache.stats()
+            stats["cover_image"] = self._spotify.cover_cache.stats()
+            stats["avatar_image"] = self._spotify.avatar_cache.stats()
+        stats["producer_songs"] = self.shared_songs.stats()
+        stats["producer_index"] = self.producer_index.stats()
+        return stats
+
     def set_spotify_access_token_response(self, access_token_response: dict) -> None:
         """"""
         self._spotify.set_access_token_response(access_token_response=access_token_response)
 
-    async def update_progress(self, task_id, progress, current_step):
-        """Update task progress in Redis with user-specific namespace"""
+    async def _write_task_state(self, task_id, fields: dict, event: dict) -> None:
+        """Store fields in the task state, refresh its expiration and notify its watchers of event, in a single
+        round trip and atomically, numbered by the sequence of the task"""
         task_key = f"user:{self.user_id}:task:{task_id}"
-        await self.redis_client.hset(task_key, mapping={"progress": progress, "current_step": current_step})
-        await self.redis_client.expire(task_key, 3600)  # 1 hour expiration
+        args = [self.TASK_STATE_TTL, ProgressHub.channel(self.user_id, task_id), json.dumps(event)]
+        for field, value in fields.items():
+            args += [field, value]
+        await self._write_task_state_script(keys=[task_key], args=args)
+
+    async def update_progress(self, task_id, progress, current_step, details: Optional[dict] = None):
+        """Update task progress in Redis with user-specific namespace
+
+        details are the SongsProgress.details() of the current stage, cleared if None.
+        """
+        details = details or dict.fromkeys(self.PROGRESS_DETAILS)
+        event = {"progress": progress, "current_step": current_step, **details}
+        fields = {"progress": progress, "current_step": current_step}
+        fields.update({key: json.dumps(value) for key, value in details.items()})
+        await self._write_task_state(task_id, fields, event)
 
     async def set_result(self, task_id, result):
         """Set task result with user-specific namespacing"""
-        task_key = f"user:{self.user_id}:task:{task_id}"
-        await self.redis_client.hset(task_key, mapping={"result": json.dumps(result), "completed": 1})
-        await self.redis_client.expire(task_key, 3600)
+        fields = {"result": json.dumps(result), "completed": 1}
+        await self._write_task_state(task_id, fields, {"result": result, "completed": True})
 
     async def set_error(self, task_id, error):
         """Set error state with user-specific namespacing"""
-        task_key = f"user:{self.user_id}:task:{task_id}"
-        await self.redis_client.hset(task_key, mapping={"error": error, "completed": 1})
-        await self.redis_client.expire(task_key, 3600)
+        fields = {"error": error, "completed": 1}
+        await self._write_task_state(task_id, fields, {"error": error, "completed": True})
 
     async def get_state(self, task_id):
         """Retrieve task state with user-specific namespacing"""
@@ -81,46 +182,105 @@ class BeatmakerPlaylist:
             decoded_state["result"] = json.loads(decoded_state["result"])
         dict = {
             "task_id": task_id,
+            "sequence": int(decoded_state.get("sequence", 0)),
             "progress": int(decoded_state.get("progress", 0)),
             "current_step": decoded_state.get("current_step"),
             "completed": bool(int(decoded_state.get("completed", 0))),
             "result": decoded_state.get("result"),
             "error": decoded_state.get("error"),
         }
+        for key in self.PROGRESS_DETAILS:
+            dict[key] = json.loads(decoded_state[key]) if key in decoded_state else None
         return dict
 
-    async def make_playlist(self, beatmaker_name: str, task_id: str) -> BeatmakerPlaylistResults:
-        """"""
+    async def watch_state(self, task_id, progress_hub: ProgressHub) -> AsyncIterator[dict]:
+        """Yield the task state once, then again each time it changes, until the task is completed
+
+        The state is read again if no event is received for STATE_RESYNC_INTERVAL seconds, in case an event was
+        lost while the subscription of the hub was reconnecting.
+        """
+        async with progress_hub.watch(self.user_id, task_id) as events:
+            task_state = await self.get_state(task_id)
+            yield task_state
+            while not task_state["completed"]:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=self.STATE_RESYNC_INTERVAL)
+                except asyncio.TimeoutError:
+                    task_state = await self.get_state(task_id)
+                    yield task_state
+                    continue
+                # Events sent before the last read of the state may arrive after it. The progress is not compared,
+                # it goes back to 0 when the task is retried.
+                if event["sequence"] <= task_state["sequence"]:
+                    continue
+                task_state = {**task_state, **event}
+                yield task_state
+
+    async def make_playlist(
+        self, beatmaker_name: str, task_id: str, report_errors: bool = True, checkpoint: Optional[Checkpoint] = None
+    ) -> BeatmakerPlaylistResults:
+        """Without report_errors, errors are only raised, for the caller to retry or report them
+
+        With the checkpoint of a previous attempt, the playlist it created is completed instead of creating another
+        one.
+        """
+        checkpoint = checkpoint or Checkpoint()
         try:
             await self.update_progress(task_id, 0, f"Searching {beatmaker_name} on Genius")
             # Get producer id from name
             genius_beatmaker_name, genius_beatmaker_id = await self._genius.get_producer_id(beatmaker_name)
 
-            # Get all songs from producer
-            await self.update_progress(task_id, 10, f"Getting all songs from {beatmaker_name} on Genius")
-            genius_beatmaker_songs = await self._genius.get_songs(beatmaker_id=genius_beatmaker_id)
-
-            # Build song search list (title + artist name) for Spotify
-            await self.update_progress(task_id, 20, f"Removing songs not produced by {beatmaker_name}")
-            genius_songs_produced, genius_songs_not_produced = await self._genius.build_song_search(
-                genius_beatmaker_songs, genius_beatmaker_id
+            # Songs and matches of the producer, shared with the other users building the same playlist
+            await self.update_progress(
+                task_id, 10, f"Getting songs from {beatmaker_name} on Genius and matching them on Spotify"
             )
-
-            # Build the list of Spotify song IDs to add to the playlist
-            await self.update_progress(task_id, 30, "Matching songs on Spotify")
-            matches = await self._spotify.build_song_id_list(genius_songs_produced)
+            # Progress is reported by every user waiting for the songs, not only the one building them
+            progress = SongsProgress()
+            done = asyncio.Event()
+            reporter = asyncio.create_task(self._report_progress(task_id, progress, (10, 70), done))
+            try:
+                producer_songs = await self.shared_songs.get_or_build(
+                    genius_beatmaker_id,
+                    self._spotify.market,
+                    lambda build_progress: self._build_producer_songs(
+                        genius_beatmaker_name, genius_beatmaker_id, build_progress
+                    ),
+                    progress,
+                )
+            finally:
+                done.set()
+                await reporter
+            genius_song_ids = producer_songs.song_ids
+            genius_songs_produced = producer_songs.songs_produced
+            genius_songs_not_produced = producer_songs.songs_not_produced
+            matches = producer_songs.matches
 
             # Get producer image url from Genius
             await self.update_progress(task_id, 70, "Downloading beatmaker image from Genius")
             beatmaker_image_url = await self._genius.get_producer_image_url(genius_beatmaker_id)
 
-            # Create playlist
+            # Create playlist, unless a previous attempt did
             await self.update_progress(task_id, 80, "Creating Spotify playlist")
-            playlist: Playlist = await self._spotify.create_playlist(genius_beatmaker_name, beatmaker_image_url)
+            created_playlist = checkpoint.get("playlist")
+            if created_playlist is None:
+                playlist: Playlist = await self._spotify.create_playlist(genius_beatmaker_name)
+                await checkpoint.set(playlist=[playlist.id, playlist.name, playlist.url])
+            else:
+                playlist = Playlist(*created_playlist, "")
+            await self._spotify.upload_cover_image(playlist, beatmaker_image_url)
 
-            # Add tracks by ids
+            # Add tracks by ids, skipping the ones added by a previous attempt
             await self.update_progress(task_id, 90, "Adding tracks to Spotify playlist")
-            await self._spotify.add_tracks(playlist, matches)
+            if created_playlist is None:
+                await self._spotify.add_tracks(playlist, matches, start_position=0)
+            else:
+                added_track_ids = set(await self._spotify.get_playlist_track_ids(playlist))
+                await self._spotify.add_tracks(
+                    playlist, [match for match in matches if match.id not in added_track_ids]
+                )
+            await self.save_playlist_state(
+                playlist, genius_beatmaker_name, genius_beatmaker_id, genius_song_ids, matches
+            )
             await self.update_progress(task_id, 100, "Finished!")
 
             beatmaker_playlist_results = BeatmakerPlaylistResults(
@@ -133,9 +293,188 @@ class BeatmakerPlaylist:
             )
 
             # await self.set_result(task_id, asdict(beatmaker_playlist_results))
-            await self.set_result(task_id, {"playlist_url": playlist.url})
+            await self.set_result(task_id, {"playlist_url": playlist.url, "playlist_id": playlist.id})
             return beatmaker_playlist_results
         except Exception as e:
             logging.info(f"Exception raised in make_playlist: {e}")
-            await self.set_error(task_id, str(e))
+            if report_errors:
+                await self.set_error(task_id, str(e))
+            raise
+
+    async def refresh_playlist(
+        self, playlist_id: str, task_id: str, report_errors: bool = True, checkpoint: Optional[Checkpoint] = None
+    ) -> BeatmakerPlaylistResults:
+        """Add the songs released since the playlist was created or last refreshed
+
+        Without report_errors, errors are only raised, for the caller to retry or report them. With the checkpoint
+        of a previous attempt which started adding tracks, the tracks already in the playlist are not added again.
+        """
+        checkpoint = checkpoint or Checkpoint()
+        try:
+            await self.update_progress(task_id, 0, "Loading playlist")
+            state = await self.get_playlist_state(playlist_id)
+            if state is None or state["owner"] != self._spotify.user_id:
+                raise ValueError(f"Playlist {playlist_id} cannot be refreshed")
+            genius_beatmaker_name = state["beatmaker_name"]
+            genius_beatmaker_id = state["beatmaker_id"]
+
+            # Only songs released since the last crawl go through the Genius and Spotify stages
+            await self.update_progress(task_id, 10, f"Getting new songs from {genius_beatmaker_name} on Genius")
+            new_songs = self._genius.iter_new_songs(genius_beatmaker_id, set(state["song_ids"]))
+            genius_song_ids, genius_songs_produced, genius_songs_not_produced, matches = await self._match_songs(
+                new_songs, genius_beatmaker_id, task_id, (10, 90)
+            )
+
+            # Add tracks not already in the playlist
+            await self.update_progress(task_id, 90, "Adding new tracks to Spotify playlist")
+            playlist = Playlist(playlist_id, state["name"], state["url"], "")
+            known_track_ids = {match.id for match in state["matches"]}
+            if checkpoint.get("adding_tracks"):
+                known_track_ids.update(await self._spotify.get_playlist_track_ids(playlist))
+            await checkpoint.set(adding_tracks=True)
+            new_matches = [match for match in matches if match.id is not None and match.id not in known_track_ids]
+            await self._spotify.add_tracks(playlist, new_matches)
+            await self.save_playlist_state(
+                playlist,
+                genius_beatmaker_name,
+                genius_beatmaker_id,
+                genius_song_ids + state["song_ids"],
+                state["matches"] + matches,
+            )
+            await self.update_progress(task_id, 100, "Finished!")
+            logging.info(f"{len(new_matches)} new tracks added to playlist {playlist_id}")
+
+            beatmaker_playlist_results = BeatmakerPlaylistResults(
+                genius_beatmaker_name,
+                genius_beatmaker_id,
+                genius_songs_produced,
+                genius_songs_not_produced,
+                new_matches,
+                playlist,
+            )
+            await self.set_result(
+                task_id, {"playlist_url": playlist.url, "playlist_id": playlist.id, "added_tracks": len(new_matches)}
+            )
+            return beatmaker_playlist_results
+        except Exception as e:
+            logging.info(f"Exception raised in refresh_playlist: {e}")
+            if report_errors:
+                await self.set_error(task_id, str(e))
             raise
+
+    async def _build_producer_songs(
+        self, beatmaker_name: str, beatmaker_id: int, progress: SongsProgress
+    ) -> ProducerSongs:
+        """Stream songs from producer through the Genius details and Spotify search stages"""
+        song_ids, songs_produced, songs_not_produced, matches = await self._match_songs(
+            self._genius.iter_songs(beatmaker_id), beatmaker_id, progress=progress
+        )
+        return ProducerSongs(beatmaker_name, beatmaker_id, song_ids, songs_produced, songs_not_produced, matches)
+
+    async def _report_progress(
+        self, task_id, progress: SongsProgress, progress_range: tuple[int, int], done: asyncio.Event
+    ) -> None:
+        """Report the progress of the songs every PROGRESS_INTERVAL seconds, if it changed, until done is set"""
+        start, end = progress_range
+        percent = start
+        last_reported = None
+        while not done.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(done.wait(), timeout=self.PROGRESS_INTERVAL)
+            progress.sample()
+            counts = (progress.songs_found, progress.songs_done)
+            if done.is_set() or counts == last_reported:
+                continue
+            last_reported = counts
+            # The number of songs found grows while listing them, progress must not go backwards
+            percent = max(percent, int(start + (end - start) * progress.fraction()))
+            current_step = f"Matching songs on Spotify ({progress.songs_done}/{progress.songs_found})"
+            await self.update_progress(task_id, percent, current_step, progress.details())
+
+    async def _match_songs(
+        self,
+        songs: AsyncIterable[dict],
+        beatmaker_id,
+        task_id=None,
+        progress_range: tuple[int, int] = (0, 100),
+        progress: Optional[SongsProgress] = None,
+    ):
+        """Stream Genius songs through the Genius details and Spotify search stages, counting them in progress
+
+        With a task_id, the progress of the songs is reported within progress_range.
+        """
+        song_ids: list[int] = []
+        songs_produced: list[Track] = []
+        songs_not_produced: list[Track] = []
+        progress = progress or SongsProgress()
+
+        async def recorded_songs():
+            async for song in songs:
+                song_ids.append(song["id"])
+                progress.songs_found += 1
+                yield song
+
+        async def produced_tracks():
+            # Only songs produced by the beatmaker are searched on Spotify
+            buffered_songs = buffered(recorded_songs(), self.QUEUE_SIZE)
+            async for track, produced in self._genius.iter_song_search(buffered_songs, beatmaker_id):
+                if produced:
+                    songs_produced.append(track)
+                    yield track
+                else:
+                    songs_not_produced.append(track)
+                    progress.songs_done += 1
+
+        async def matched_tracks():
+            tracks = buffered(produced_tracks(), self.QUEUE_SIZE)
+            async for match in self._spotify.iter_song_id_list(tracks):
+                progress.songs_done += 1
+                yield match
+
+        done = asyncio.Event()
+        reporter = None
+        if task_id is not None:
+            reporter = asyncio.create_task(self._report_progress(task_id, progress, progress_range, done))
+        try:
+            matches = [match async for match in matched_tracks()]
+        finally:
+            done.set()
+            if reporter is not None:
+                await reporter
+        return song_ids, songs_produced, songs_not_produced, matches
+
+    async def save_playlist_state(
+        self, playlist: Playlist, beatmaker_name: str, beatmaker_id: int, song_ids: list[int], matches: list[Match]
+    ) -> None:
+        """Store what is needed to refresh the playlist later"""
+        playlist_key = f"playlist:{playlist.id}"
+        state = {
+            "owner": self._spotify.user_id,
+            "name": playlist.name,
+            "url": playlist.url,
+            "beatmaker_name": beatmaker_name,
+            "beatmaker_id": beatmaker_id,
+            "song_ids": json.dumps(song_ids),
+            "matches": json.dumps([[match.track.artist, match.track.title, match.id] for match in matches]),
+        }
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(playlist_key, mapping=state)
+            pipe.expire(playlist_key, self.PLAYLIST_STATE_TTL)
+            await pipe.execute()
+
+    async def get_playlist_state(self, playlist_id: str) -> Optional[dict]:
+        """"""
+        playlist_key = f"playlist:{playlist_id}"
+        state = await self.redis_client.hgetall(playlist_key)
+        if not state:
+            return None
+        decoded_state = {k.decode(): v.decode() for k, v in state.items()}
+        return {
+            "owner": decoded_state["owner"],
+            "name": decoded_state["name"],
+            "url": decoded_state["url"],
+            "beatmaker_name": decoded_state["beatmaker_name"],
+            "beatmaker_id": int(decoded_state["beatmaker_id"]),
+            "song_ids": json.loads(decoded_state["song_ids"]),
+            "matches": [Match(Track(artist, title), id) for artist, title, id in json.loads(decoded_state["matches"])],
+        }
@@ -0,0 +1,237 @@
+from dataclasses import dataclass
+import io
+from pathlib import Path
+from time import perf_counter
+import json
+import logging
+import multiprocessing
+import re
+import sys
+import tracemalloc
+import unidecode
+from PIL import Image
+
+import decoding
+from genius import Genius
+from utils import ImageTooBig, Track, clean_json_str, cover_images, normalize_string
+
+
+def _sample_titles(count: int) -> list[str]:
+    """Genius-like song titles, with accents, features and brackets"""
+    return [f"Chanson n°{i} à l'été (feat. Artiste {i % 50}) [Remix {i % 7}]" for i in range(count)]
+
+
+def _normalize_string_baseline(string: str) -> str:
+    """normalize_string before memoization, with an uncompiled regex"""
+    safe_string = unidecode.unidecode(string).lower()
+    cleaned_string = re.sub(r"[\(\[].*?[\)\]]", "", safe_string)
+    return cleaned_string
+
+
+def bench_normalize(songs: int = 2000, repeats: int = 50) -> None:
+    """Normalizations per second, each string being normalized repeats times as during matching"""
+    titles = _sample_titles(songs)
+    for name, normalize in (("before", _normalize_string_baseline), ("after", normalize_string)):
+        normalize_string.cache_clear()
+        start_time = perf_counter()
+        for _ in range(repeats):
+            for title in titles:
+                normalize(title)
+        total_time = perf_counter() - start_time
+        logging.info(f"normalize_string {name}: {songs * repeats / total_time:,.0f} normalizations/s")
+
+
+@dataclass
+class _TrackBaseline:
+    """Track before slots"""
+
+    artist: str
+    title: str
+
+
+def _song_payloads(songs: int):
+    """Genius-like /songs/{id} JSON bodies, generated one at a time as they would arrive from the network"""
+    for song_id in range(songs):
+        song = {
+            "id": song_id,
+            "title": f"Chanson {song_id}",
+            "full_title": f"Chanson {song_id} by Artiste {song_id % 50}",
+            "description": {"dom": {"tag": "root", "children": ["Lorem ipsum dolor sit amet " * 200]}},
+            "primary_artist": {"id": song_id % 50, "name": f"Artiste {song_id % 50}", "url": "https://genius.com"},
+            "producer_artists": [{"id": 1, "name": "Kosei", "image_url": "https://images.genius.com/kosei.jpg"}],
+            "album": {
+                "id": song_id % 20,
+                "name": f"Album {song_id % 20}",
+                "cover_art_url": "https://images.genius.com",
+            },
+            "media": [{"provider": "youtube", "url": f"https://www.youtube.com/watch?v={song_id}"}] * 3,
+            "song_relationships": [{"type": "samples", "songs": []}] * 12,
+        }
+        yield json.dumps({"meta": {"status": 200}, "response": {"song": song}})
+
+
+def _build_before(songs: int) -> int:
+    """Keep every payload until all are received, like the former asyncio.gather of build_song_search"""
+    detailed_songs = [json.loads(payload) for payload in _song_payloads(songs)]
+    tracks = []
+    for detailed_song in detailed_songs:
+        title = clean_json_str(detailed_song["response"]["song"]["title"])
+        artist = clean_json_str(detailed_song["response"]["song"]["primary_artist"]["name"])
+        tracks.append(_TrackBaseline(artist=artist, title=title))
+    return len(tracks)
+
+
+def _build_after(songs: int) -> int:
+    """Project each payload as soon as it is received"""
+    tracks = []
+    for payload in _song_payloads(songs):
+        detailed_song = Genius.song_projection(json.loads(payload)["response"]["song"])
+        title = clean_json_str(detailed_song["title"])
+        artist = clean_json_str(detailed_song["primary_artist"])
+        tracks.append(Track(artist=artist, title=title))
+    return len(tracks)
+
+
+def _peak_memory(build, songs: int) -> int:
+    """Peak bytes allocated by a build, traced by tracemalloc
+
+    ru_maxrss is not used: on Linux a spawned process keeps the high-water mark of its parent.
+    """
+    tracemalloc.start()
+    build(songs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_memory(songs: int = 2000) -> None:
+    """Peak memory of the Genius stage of a build, each variant running in a fresh process"""
+    context = multiprocessing.get_context("spawn")
+    for name, build in (("before", _build_before), ("after", _build_after)):
+        with context.Pool(1) as pool:
+            peak = pool.apply(_peak_memory, (build, songs))
+        logging.info(f"{songs}-song build {name}: peak memory {peak / 1024 / 1024:.1f} MB")
+
+
+# Recorded Genius /songs/{id} bodies, one per file. Generated ones are used if there is none.
+RECORDED_SONGS_DIRECTORY = Path("debug/songs")
+
+
+def _recorded_song_payloads(songs: int) -> list[bytes]:
+    """Bodies of the recorded /songs/{id} responses, or generated ones, as received from the network"""
+    paths = sorted(RECORDED_SONGS_DIRECTORY.glob("*.json"))[:songs] if RECORDED_SONGS_DIRECTORY.is_dir() else []
+    if paths:
+        return [path.read_bytes() for path in paths]
+    return [payload.encode("utf-8") for payload in _song_payloads(songs)]
+
+
+def bench_decode(songs: int = 2000, repeats: int = 5) -> None:
+    """Parse time and allocations of the /songs/{id} bodies, for each available JSON decoder"""
+    payloads = _recorded_song_payloads(songs)
+    decoders = {"text + json.loads (before)": lambda payload: json.loads(payload.decode("utf-8"))}
+    decoders["json.loads bytes"] = json.loads
+    if decoding.orjson is not None:
+        decoders["orjson"] = decoding.orjson.loads
+    if decoding.msgspec is not None:
+        decoders["msgspec"] = decoding.msgspec.json.decode
+        decoders["msgspec typed"] = decoding.GENIUS_SONG_DECODER
+    for name, decode in decoders.items():
+        start_time = perf_counter()
+        for _ in range(repeats):
+            for payload in payloads:
+                decode(payload)
+        total_time = perf_counter() - start_time
+        tracemalloc.start()
+        songs_decoded = [decode(payload) for payload in payloads]
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del songs_decoded
+        logging.info(
+            f"{name}: {total_time / (repeats * len(payloads)) * 1e6:.1f} µs/song, "
+            f"{retained / len(payloads) / 1024:.1f} kB retained/song, peak {peak / 1024 / 1024:.1f} MB"
+        )
+
+
+def _sample_covers() -> dict[str, bytes]:
+    """Genius-like covers: a large photo-like JPEG, a noisy JPEG and a transparent PNG"""
+    covers = {}
+    gradient = Image.linear_gradient("L").resize((1000, 1000))
+    photo = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+    noise = Image.effect_noise((1000, 1000), 100).convert("RGB")
+    transparent = Image.merge("RGBA", (gradient, gradient.rotate(90), gradient.rotate(180), gradient.rotate(270)))
+    for name, image, format in (("photo", photo, "JPEG"), ("noise", noise, "JPEG"), ("png", transparent, "PNG")):
+        output_buffer = io.BytesIO()
+        image.save(output_buffer, format=format)
+        covers[name] = output_buffer.getvalue()
+    return covers
+
+
+def _cover_images_baseline(bytes: bytes, target_size_kb: int, upload_size: tuple, thumbnail_size: tuple) -> tuple:
+    """compress_image then resize_image before the single-decode pipeline: each decodes the cover, and quality
+    goes down in steps of 5"""
+    image = Image.open(io.BytesIO(bytes))
+    image.thumbnail(upload_size, Image.Resampling.LANCZOS)
+    upload = None
+    for quality in range(95, 10, -5):
+        output_buffer = io.BytesIO()
+        image.save(output_buffer, format=image.format, quality=quality, optimize=True)
+        if output_buffer.tell() <= target_size_kb * 1024:
+            upload = output_buffer.getvalue()
+            break
+    if upload is None:
+        raise ImageTooBig
+    image = Image.open(io.BytesIO(bytes))
+    image.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format=image.format, quality=95)
+    return upload, output_buffer.getvalue()
+
+
+def bench_images(repeats: int = 5) -> None:
+    """Decodes, encodes and time per cover, before and after the single-decode pipeline"""
+    counts = {"decodes": 0, "encodes": 0}
+    image_open, image_save = Image.open, Image.Image.save
+
+    def counted_open(*args, **kwargs):
+        counts["decodes"] += 1
+        return image_open(*args, **kwargs)
+
+    def counted_save(*args, **kwargs):
+        counts["encodes"] += 1
+        return image_save(*args, **kwargs)
+
+    Image.open, Image.Image.save = counted_open, counted_save
+    try:
+        for cover_name, cover in _sample_covers().items():
+            # Spotify budget, and a tight one making the quality search run
+            for target_size_kb in (256, 16):
+                for name, build in (("before", _cover_images_baseline), ("after", cover_images)):
+                    counts.update(decodes=0, encodes=0)
+                    start_time = perf_counter()
+                    try:
+                        for _ in range(repeats):
+                            build(cover, target_size_kb, (300, 300), (200, 200))
+                    except (ImageTooBig, OSError) as error:
+                        logging.info(f"{cover_name} {target_size_kb} kB {name}: failed ({error!r})")
+                        continue
+                    total_time = perf_counter() - start_time
+                    logging.info(
+                        f"{cover_name} {target_size_kb} kB {name}: {counts['decodes'] / repeats:.0f} decodes, "
+                        f"{counts['encodes'] / repeats:.0f} encodes, {total_time / repeats * 1000:.1f} ms/cover"
+                    )
+    finally:
+        Image.open, Image.Image.save = image_open, image_save
+
+
+BENCHMARKS = {
+    "normalize": bench_normalize,
+    "memory": bench_memory,
+    "decode": bench_decode,
+    "images": bench_images,
+}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="{asctime} - {levelname} - {message}", style="{")
+    for benchmark_name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[benchmark_name]()
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import json
+import time
+from typing import Awaitable, Callable, Optional
+import redis.asyncio as redis
+
+
+class RedisCache:
+    """Read-through JSON cache stored in Redis, evicting the least recently used entries above max_entries"""
+
+    def __init__(self, redis_client: redis.Redis, namespace: str, ttl: int, max_entries: Optional[int] = None):
+        """"""
+        self._redis = redis_client
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Sorted set of the cache keys, scored by last access time
+        self._index_key = f"cache:{namespace}:index"
+
+    def _key(self, key) -> str:
+        """"""
+        return f"cache:{self.namespace}:{key}"
+
+    async def get(self, key):
+        """Return the cached value, or None if absent"""
+        cache_key = self._key(key)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.get(cache_key)
+            pipe.zadd(self._index_key, {cache_key: time.time()}, xx=True)
+            raw_value, _ = await pipe.execute()
+        if raw_value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw_value)
+
+    async def set(self, key, value, ttl: Optional[int] = None) -> None:
+        """"""
+        cache_key = self._key(key)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(cache_key, json.dumps(value, separators=(",", ":")), ex=ttl or self.ttl)
+            pipe.zadd(self._index_key, {cache_key: time.time()})
+            pipe.zcard(self._index_key)
+            *_, entries = await pipe.execute()
+        if self.max_entries and entries > self.max_entries:
+            await self._evict(entries - self.max_entries)
+
+    async def _evict(self, count: int) -> None:
+        """Remove the count least recently used entries"""
+        evicted_keys = await self._redis.zrange(self._index_key, 0, count - 1)
+        if evicted_keys:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*evicted_keys)
+                pipe.zrem(self._index_key, *evicted_keys)
+                await pipe.execute()
+
+    async def get_or_fetch(self, key, fetch: Callable[[], Awaitable]):
+        """Return the cached value, calling fetch and caching its result on a miss"""
+        value = await self.get(key)
+        if value is None:
+            value = await fetch()
+            await self.set(key, value)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class LRUCache:
+    """In-process cache keeping the maxsize most recently used entries, each with its own TTL"""
+
+    def __init__(self, maxsize: int, ttl: int):
+        """"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    async def get(self, key):
+        """Return the cached value, or None if absent or expired"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key, value, ttl: Optional[int] = None) -> None:
+        """"""
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class TieredCache:
+    """In-process LRU in front of a shared Redis cache"""
+
+    def __init__(self, local: LRUCache, remote: RedisCache):
+        """"""
+        self.local = local
+        self.remote = remote
+
+    async def get(self, key):
+        """"""
+        value = await self.local.get(key)
+        if value is None:
+            value = await self.remote.get(key)
+            if value is not None:
+                await self.local.set(key, value)
+        return value
+
+    async def set(self, key, value, ttl: Optional[int] = None) -> None:
+        """"""
+        await self.local.set(key, value, ttl=ttl)
+        await self.remote.set(key, value, ttl=ttl)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """"""
+        return {"local": self.local.stats(), "remote": self.remote.stats()}
@@ -1,16 +1,16 @@
 from time import perf_counter
 import asyncio
-import aiohttp
 import logging
 
 from beatmaker_playlist import BeatmakerPlaylist, BeatmakerPlaylistResults
+from http_client import SessionPool
 import secret_keys
 
 
 async def create_playlist(beatmaker_name: str) -> None:
     start_time = perf_counter()
 
-    client = aiohttp.ClientSession()
+    client = SessionPool()
     playlist_manager = BeatmakerPlaylist(client=client, debug=True, faster_tests=secret_keys.FASTER_TESTS)
 
     # Get access token
@@ -0,0 +1,137 @@
+import json
+from typing import Optional, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes):
+    """Parse a JSON body straight from the response bytes, with the fastest library installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+class JsonDecoder:
+    """Decode a JSON body into plain dicts and lists
+
+    Given a payload type and with msgspec installed, only the fields declared by the type are built, the others
+    being skipped while parsing. Without msgspec, the whole body is decoded.
+    """
+
+    def __init__(self, payload_type: type = None):
+        """"""
+        self.payload_type = payload_type
+        if msgspec is not None and payload_type is not None:
+            self._decode = msgspec.json.Decoder(payload_type).decode
+        else:
+            self._decode = loads
+
+    def __call__(self, data: bytes):
+        """"""
+        return self._decode(data)
+
+
+# Fields of the Genius payloads read by Genius
+
+
+class GeniusArtist(TypedDict):
+    id: int
+    name: str
+
+
+class GeniusSong(TypedDict):
+    id: int
+    title: str
+    primary_artist: GeniusArtist
+    producer_artists: list[GeniusArtist]
+
+
+class GeniusSongResponse(TypedDict):
+    song: GeniusSong
+
+
+class GeniusSongPayload(TypedDict):
+    response: GeniusSongResponse
+
+
+class GeniusArtistDetails(TypedDict):
+    id: int
+    name: str
+    image_url: Optional[str]
+
+
+class GeniusArtistResponse(TypedDict):
+    artist: GeniusArtistDetails
+
+
+class GeniusArtistPayload(TypedDict):
+    response: GeniusArtistResponse
+
+
+class GeniusSongSummary(TypedDict):
+    id: int
+    title: str
+
+
+class GeniusArtistSongsResponse(TypedDict):
+    songs: list[GeniusSongSummary]
+    next_page: Optional[int]
+
+
+class GeniusArtistSongsPayload(TypedDict):
+    response: GeniusArtistSongsResponse
+
+
+class GeniusSearchResult(TypedDict):
+    id: int
+    full_title: str
+
+
+class GeniusSearchHit(TypedDict):
+    result: GeniusSearchResult
+
+
+class GeniusSearchResponse(TypedDict):
+    hits: list[GeniusSearchHit]
+
+
+class GeniusSearchPayload(TypedDict):
+    response: GeniusSearchResponse
+
+
+# Fields of the Spotify search payload read by Spotify, which may be missing
+
+
+class SpotifyArtist(TypedDict, total=False):
+    name: Optional[str]
+
+
+class SpotifyTrack(TypedDict, total=False):
+    id: Optional[str]
+    name: Optional[str]
+    artists: list[SpotifyArtist]
+
+
+class SpotifyTracks(TypedDict, total=False):
+    items: list[SpotifyTrack]
+
+
+class SpotifySearchPayload(TypedDict, total=False):
+    tracks: SpotifyTracks
+
+
+GENIUS_SONG_DECODER = JsonDecoder(GeniusSongPayload)
+GENIUS_ARTIST_DECODER = JsonDecoder(GeniusArtistPayload)
+GENIUS_ARTIST_SONGS_DECODER = JsonDecoder(GeniusArtistSongsPayload)
+GENIUS_SEARCH_DECODER = JsonDecoder(GeniusSearchPayload)
+SPOTIFY_SEARCH_DECODER = JsonDecoder(SpotifySearchPayload)
+DEFAULT_DECODER = JsonDecoder()
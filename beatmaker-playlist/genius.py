@@ -1,8 +1,18 @@
 import logging
 import asyncio
-import aiohttp
-
-from http_client import HttpClient
+from typing import AsyncIterable, AsyncIterator, Optional
+import redis.asyncio as redis
+
+from cache import RedisCache
+from decoding import (
+    GENIUS_ARTIST_DECODER,
+    GENIUS_ARTIST_SONGS_DECODER,
+    GENIUS_SEARCH_DECODER,
+    GENIUS_SONG_DECODER,
+)
+from http_client import HttpClient, SessionPool
+from pipeline import imap
+from producer_index import ProducerIndex
 from utils import Track, clean_json_str
 import secret_keys
 
@@ -11,119 +21,224 @@ class Genius(HttpClient):
     """"""
 
     BASE_URL = "https://api.genius.com"
-
-    def __init__(self, session: aiohttp.ClientSession, debug: bool = False, faster_tests: bool = False):
+    # Every request uses the client access token of the app
+    PUBLIC_API = True
+    MAX_CONCURRENT_REQUESTS = 20
+    SONG_CACHE_TTL = 7 * 24 * 3600
+    SONG_CACHE_MAX_ENTRIES = 200_000
+    ARTIST_CACHE_TTL = 24 * 3600
+    ARTIST_CACHE_MAX_ENTRIES = 20_000
+    # Artist songs pages requested ahead of the one being read
+    PREFETCH_PAGES = 4
+    # Search pages scanned at once when looking for a producer
+    SEARCH_PAGES = 3
+
+    def __init__(
+        self,
+        session: SessionPool,
+        debug: bool = False,
+        faster_tests: bool = False,
+        redis_client: Optional[redis.Redis] = None,
+        producer_index: Optional[ProducerIndex] = None,
+    ):
         """"""
         super().__init__(session=session)
         self._debug = debug
         self._faster_tests = faster_tests
+        self.producer_index = producer_index
+        self.song_cache = None
+        self.artist_cache = None
+        if redis_client is not None:
+            self.song_cache = RedisCache(
+                redis_client, "genius:song", ttl=self.SONG_CACHE_TTL, max_entries=self.SONG_CACHE_MAX_ENTRIES
+            )
+            self.artist_cache = RedisCache(
+                redis_client, "genius:artist", ttl=self.ARTIST_CACHE_TTL, max_entries=self.ARTIST_CACHE_MAX_ENTRIES
+            )
 
-    async def get_producer_id(self, beatmaker_name: str):
+    async def get_song(self, song_id) -> dict:
+        """Get the title, primary artist and producers of a song, from the cache if possible, and index its
+        producers"""
+        if self.song_cache is None:
+            song = await self._fetch_song(song_id)
+        else:
+            song = await self.song_cache.get_or_fetch(song_id, lambda: self._fetch_song(song_id))
+        if self.producer_index is not None:
+            self.producer_index.add(song)
+        return song
+
+    async def _fetch_song(self, song_id) -> dict:
+        """"""
+        url = f"{self.BASE_URL}/songs/{song_id}"
+        response = await self.async_get(
+            url=url, access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN, decoder=GENIUS_SONG_DECODER
+        )
+        return self.song_projection(response["response"]["song"])
+
+    @staticmethod
+    def song_projection(song: dict) -> dict:
+        """Only keep the fields of a song payload used to build playlists"""
+        return {
+            "id": song["id"],
+            "title": song["title"],
+            "primary_artist": song["primary_artist"]["name"],
+            "producer_artists": [
+                {"id": producer["id"], "name": producer["name"]} for producer in song["producer_artists"]
+            ],
+        }
+
+    async def get_artist(self, artist_id) -> dict:
+        """Get the name and image of an artist, from the cache if possible"""
+        if self.artist_cache is None:
+            return await self._fetch_artist(artist_id)
+        return await self.artist_cache.get_or_fetch(artist_id, lambda: self._fetch_artist(artist_id))
+
+    async def _fetch_artist(self, artist_id) -> dict:
         """"""
+        url = f"{self.BASE_URL}/artists/{artist_id}"
+        params = {"per_page": 1}
+        response = await self.async_get(
+            url=url, access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN, params=params, decoder=GENIUS_ARTIST_DECODER
+        )
+        artist = response["response"]["artist"]
+        return {"id": artist["id"], "name": artist["name"], "image_url": artist["image_url"]}
+
+    async def get_producer_id(self, beatmaker_name: str):
+        """Get the Genius name and id of a producer, from the producer index if possible, otherwise from the
+        producers of the songs found by searching their name"""
+        if self.producer_index is not None:
+            producer = await self.producer_index.get_producer(beatmaker_name)
+            if producer is not None:
+                logging.info(f"Found producer '{beatmaker_name}' in index: {producer}")
+                return producer
         logging.info(f"Searching Genius.com producer_id from name '{beatmaker_name}'...")
-        page = 1
-        per_page = 3
-        next_page = True
-        while next_page:
+        url = f"{self.BASE_URL}/search"
+
+        async def search_page(page: int) -> list[dict]:
+            # The first page is smaller, the producer is usually credited on the first hits
+            per_page = 3 if page == 1 else 5
             logging.info(f"    page: {page} ({per_page} elements)")
-            url = f"{self.BASE_URL}/search"
             params = {"q": beatmaker_name, "per_page": per_page, "page": page}
             search_result = await self.async_get(
-                url=url, access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN, params=params
+                url=url,
+                access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN,
+                params=params,
+                decoder=GENIUS_SEARCH_DECODER,
             )
-
-            tasks = []
-            hits = search_result["response"]["hits"]
-            if hits:
-                for hit in hits:
-                    # Get song info from song id
-                    song_id = hit["result"]["id"]
-                    full_title = hit["result"]["full_title"]
-                    logging.info(f"    searching in song '{full_title}'")
-                    url = f"{self.BASE_URL}/songs/{song_id}"
-                    task = self.async_get(
-                        url=url,
-                        access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN,
-                    )
-                    tasks.append(task)
-
-                songs = await asyncio.gather(*tasks)
-                for song in songs:
+            return search_result["response"]["hits"]
+
+        # Up to SEARCH_PAGES search pages are requested at once, and the songs of their hits as soon as each
+        # page is received. Songs are checked as they arrive, the other requests are cancelled on a match.
+        tasks: set[asyncio.Task] = set()
+        search_tasks: set[asyncio.Task] = set()
+        pending: set[asyncio.Task] = set()
+        page = 0
+        last_page_found = False
+        try:
+            while True:
+                while not last_page_found and len(search_tasks) < self.SEARCH_PAGES:
+                    page += 1
+                    search_tasks.add(asyncio.create_task(search_page(page)))
+                pending |= search_tasks
+                tasks |= pending
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task in search_tasks:
+                        search_tasks.discard(task)
+                        hits = task.result()
+                        if not hits:
+                            last_page_found = True
+                        for hit in hits:
+                            # Get song info from song id
+                            logging.info(f"    searching in song '{hit['result']['full_title']}'")
+                            pending.add(asyncio.create_task(self.get_song(hit["result"]["id"])))
+                        continue
                     # Get producer id from song info
-                    producers = song["response"]["song"]["producer_artists"]
-                    for producer in producers:
+                    for producer in task.result()["producer_artists"]:
                         found_producer_name = producer["name"]
                         if found_producer_name.lower() == beatmaker_name.lower():
                             logging.info(f"    Found producer: {found_producer_name}")
-                            found_producer_id = song["response"]["song"]["producer_artists"][0]["id"]
-                            return found_producer_name, found_producer_id
-                page += 1
-                per_page = 5
-            else:
-                next_page = False
+                            return found_producer_name, producer["id"]
+        finally:
+            tasks |= pending
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         logging.error(f"  Producer '{beatmaker_name}' not found on Genius.com")
         return None, None
 
     async def get_producer_image_url(self, producer_id):
         """"""
-        url = f"{self.BASE_URL}/artists/{producer_id}"
         logging.info(f"Retrieving beatmaker image...")
-        params = {"per_page": 1}
-        response = await self.async_get(url=url, access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN, params=params)
-        return response["response"]["artist"]["image_url"]
+        artist = await self.get_artist(producer_id)
+        return artist["image_url"]
 
-    async def get_songs(self, beatmaker_id):
-        """Get songs from a producer"""
+    async def iter_songs(self, beatmaker_id, sort: str = "popularity") -> AsyncIterator[dict]:
+        """Yield songs from a producer in pages order, as soon as each page is received
+
+        Once the first page is received, the next PREFETCH_PAGES pages are requested speculatively, the ones past
+        the last page are cancelled.
+        """
         logging.info(f"Searching for all songs from beatmaker with id {beatmaker_id} ...")
         url = f"{self.BASE_URL}/artists/{beatmaker_id}/songs"
-        songs = []
-
-        page = 1
         per_page = 50 if not self._faster_tests else 10
-        while page:
+
+        async def fetch_page(page: int) -> tuple[list[dict], Optional[int]]:
             logging.info(f"    current page: {page} ({per_page} elements)")
-            params = {"sort": "popularity", "per_page": per_page, "page": page}
+            params = {"sort": sort, "per_page": per_page, "page": page}
             response = await self.async_get(
-                url=url, access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN, params=params
-            )
-            page_songs = response["response"]["songs"]
-            if page_songs:
-                songs += page_songs
-                page = response["response"]["next_page"] if not self._faster_tests else None
-
-        logging.info(f"    found {len(songs)} songs")
-        return songs
-
-    async def build_song_search(self, songs, beatmaker_id):
-        """"""
-        logging.info(f"Building song list...")
-        songs_produced: list[Track] = []
-        songs_not_produced: list[Track] = []
-
-        tasks = []
-        for song in songs:
-            song_id = song.get("id", None)
-            url = f"{self.BASE_URL}/songs/{song_id}"
-            task = self.async_get(
                 url=url,
                 access_token=secret_keys.GENIUS_CLIENT_ACCESS_TOKEN,
+                params=params,
+                decoder=GENIUS_ARTIST_SONGS_DECODER,
             )
-            tasks.append(task)
+            # Only keep the fields used downstream, not the full song payloads
+            page_songs = [{"id": song["id"], "title": song["title"]} for song in response["response"]["songs"]]
+            return page_songs, response["response"]["next_page"]
 
-        detailed_songs = await asyncio.gather(*tasks)
-
-        for detailed_song in detailed_songs:
-            title = clean_json_str(detailed_song["response"]["song"]["title"])
-            artist = clean_json_str(detailed_song["response"]["song"]["primary_artist"]["name"])
+        pages: dict[int, asyncio.Task] = {}
+        page = 1
+        try:
+            while page:
+                # Pages after the first one are only requested once the first one shows there are more
+                last_page = page + self.PREFETCH_PAGES if page > 1 else page
+                for prefetched_page in range(page, last_page + 1):
+                    if prefetched_page not in pages:
+                        pages[prefetched_page] = asyncio.create_task(fetch_page(prefetched_page))
+                page_songs, next_page = await pages.pop(page)
+                for song in page_songs:
+                    yield song
+                if page_songs and not self._faster_tests:
+                    page = next_page
+                else:
+                    page = None
+        finally:
+            for task in pages.values():
+                task.cancel()
+            await asyncio.gather(*pages.values(), return_exceptions=True)
+
+    async def iter_new_songs(self, beatmaker_id, known_song_ids: set) -> AsyncIterator[dict]:
+        """Yield songs from a producer, newest first, until reaching an already known song"""
+        async for song in self.iter_songs(beatmaker_id, sort="release_date"):
+            if song["id"] in known_song_ids:
+                return
+            yield song
+
+    async def iter_song_search(
+        self, songs: AsyncIterable[dict], beatmaker_id, concurrency: int = None
+    ) -> AsyncIterator[tuple[Track, bool]]:
+        """Yield (track, produced by beatmaker) pairs in songs order, fetching song details concurrently"""
+
+        async def song_search(song: dict) -> tuple[Track, bool]:
+            detailed_song = await self.get_song(song.get("id", None))
+            title = clean_json_str(detailed_song["title"])
+            artist = clean_json_str(detailed_song["primary_artist"])
             track = Track(artist=artist, title=title)
             # Check if the song is produced by the target producer
-            producer_artists = detailed_song["response"]["song"]["producer_artists"]
-            producer_artists_id = [producer["id"] for producer in producer_artists]
-            if beatmaker_id in producer_artists_id:
-                songs_produced.append(track)
-            else:
-                songs_not_produced.append(track)
-
-        total_songs = len(songs_not_produced) + len(songs_produced)
-        logging.info(f"    found {len(songs_produced)}/{total_songs} songs produced by '{beatmaker_id}' on Genius.com")
-        return songs_produced, songs_not_produced
+            producer_artists_id = [producer["id"] for producer in detailed_song["producer_artists"]]
+            return track, beatmaker_id in producer_artists_id
+
+        async for result in imap(songs, song_search, concurrency or self.MAX_CONCURRENT_REQUESTS):
+            yield result
@@ -1,7 +1,15 @@
 import asyncio
 import aiohttp
-import json
+import contextlib
+from dataclasses import dataclass
+import random
 import time
+from typing import Optional
+from urllib import parse
+import redis.asyncio as redis
+
+from decoding import DEFAULT_DECODER, JsonDecoder
+from rate_limit import RateLimiters
 
 
 class HTTPException(Exception):
@@ -13,6 +21,10 @@ class HTTPException(Exception):
         super().__init__(response, request_data, "test")
 
 
+class BadRequest(HTTPException):
+    """An exception that's thrown when status code 400 occurs."""
+
+
 class Unauthorized(HTTPException):
     """An exception that's thrown when status code 401 occurs."""
 
@@ -33,17 +45,240 @@ class RateLimitedException(Exception):
     """An exception that gets thrown when a rate limit is encountered."""
 
 
+class ConcurrencyLimiter:
+    """Bound the number of simultaneous requests sent to each host"""
+
+    def __init__(self, limit: int, per_host: dict[str, int] = {}):
+        """"""
+        self.limit = limit
+        self.per_host = dict(per_host)
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._in_flight: dict[str, int] = {}
+        self._queued: dict[str, int] = {}
+
+    def _semaphore(self, host: str) -> asyncio.Semaphore:
+        """"""
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host.get(host, self.limit))
+            self._in_flight[host] = 0
+            self._queued[host] = 0
+        return self._semaphores[host]
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, host: str):
+        """Wait for a free slot on the host, then hold it until the block exits"""
+        semaphore = self._semaphore(host)
+        self._queued[host] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._queued[host] -= 1
+        self._in_flight[host] += 1
+        try:
+            yield
+        finally:
+            self._in_flight[host] -= 1
+            semaphore.release()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """In-flight and queued request counts per host"""
+        return {
+            host: {
+                "limit": self.per_host.get(host, self.limit),
+                "in_flight": self._in_flight[host],
+                "queued": self._queued[host],
+            }
+            for host in self._semaphores
+        }
+
+
+@dataclass(slots=True)
+class ConditionalResponse:
+    """Response of a conditional GET: data is None if the resource was not modified"""
+
+    data: object
+    etag: Optional[str]
+    last_modified: Optional[str]
+    modified: bool
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls: the first one runs, the others wait for and share its result
+
+    A call is cancelled once every caller waiting for it is cancelled.
+    """
+
+    def __init__(self):
+        """"""
+        self._calls: dict[tuple, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Task) -> None:
+        """Mark the exception of a call as retrieved, even if every waiter was cancelled"""
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: tuple, fetch):
+        """Return the result of fetch(), or of the identical call already in flight for this key"""
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fetch())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key) if self._calls.get(key) is task else None)
+            task.add_done_callback(self._retrieve_exception)
+        else:
+            self.coalesced += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # A cancelled waiter must not cancel the call shared with the others
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    self.cancelled += 1
+                    # New callers must start a new call, not join the cancelled one
+                    if self._calls.get(key) is task:
+                        del self._calls[key]
+                    task.cancel()
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "in_flight": len(self._calls),
+        }
+
+
+class SessionPool:
+    """aiohttp sessions with their own connection pool for each API, so Genius and Spotify traffic never compete
+
+    Also holds the concurrency limits of the hosts, the rate limiters of the APIs, shared like the sessions by
+    every client of the process, and by every process when given a Redis client, and the single-flight of GET
+    requests.
+    """
+
+    # Host -> (pool name, maximum number of connections)
+    HOST_POOLS = {
+        "api.genius.com": ("genius", 30),
+        "api.spotify.com": ("spotify", 30),
+        "accounts.spotify.com": ("spotify_accounts", 10),
+    }
+    # Any other host (Genius and Spotify image CDNs), with a limit for each of them
+    DEFAULT_POOL = ("images", 40)
+    DEFAULT_LIMIT_PER_HOST = 10
+    # Simultaneous requests to each host, for all the jobs of the process
+    HOST_CONCURRENCY = {
+        "api.genius.com": 20,
+        "api.spotify.com": 20,
+    }
+    DEFAULT_CONCURRENCY = 10
+    DNS_CACHE_TTL = 300
+    KEEPALIVE_TIMEOUT = 30
+    TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+
+    def __init__(
+        self,
+        host_pools: dict[str, tuple[str, int]] = None,
+        default_pool: tuple[str, int] = None,
+        default_limit_per_host: int = None,
+        dns_cache_ttl: int = None,
+        keepalive_timeout: float = None,
+        timeout: aiohttp.ClientTimeout = None,
+        redis_client: Optional[redis.Redis] = None,
+        host_concurrency: dict[str, int] = None,
+        default_concurrency: int = None,
+    ):
+        """"""
+        self.host_pools = host_pools or self.HOST_POOLS
+        self.default_pool = default_pool or self.DEFAULT_POOL
+        self.default_limit_per_host = default_limit_per_host or self.DEFAULT_LIMIT_PER_HOST
+        self.dns_cache_ttl = dns_cache_ttl or self.DNS_CACHE_TTL
+        self.keepalive_timeout = keepalive_timeout or self.KEEPALIVE_TIMEOUT
+        self.timeout = timeout or self.TIMEOUT
+        self.concurrency_limiter = ConcurrencyLimiter(
+            default_concurrency or self.DEFAULT_CONCURRENCY, host_concurrency or self.HOST_CONCURRENCY
+        )
+        self.rate_limiters = RateLimiters(redis_client=redis_client)
+        self.single_flight = SingleFlight()
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+        self._limits: dict[str, int] = {}
+        self._active: dict[str, int] = {}
+
+    def _pool(self, host: str) -> tuple[str, int]:
+        """"""
+        return self.host_pools.get(host, self.default_pool)
+
+    def _session(self, pool_name: str, limit: int) -> aiohttp.ClientSession:
+        """"""
+        if pool_name not in self._sessions:
+            limit_per_host = limit if pool_name != self.default_pool[0] else self.default_limit_per_host
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._sessions[pool_name] = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._limits[pool_name] = limit
+            self._active[pool_name] = 0
+        return self._sessions[pool_name]
+
+    @contextlib.asynccontextmanager
+    async def session(self, host: str):
+        """Yield the session of the host pool, counting the requests using it until the block exits"""
+        pool_name, limit = self._pool(host)
+        session = self._session(pool_name, limit)
+        self._active[pool_name] += 1
+        try:
+            yield session
+        finally:
+            self._active[pool_name] -= 1
+
+    def stats(self) -> dict[str, dict]:
+        """Active requests of each pool, and how many of them wait for a free connection"""
+        return {
+            pool_name: {
+                "limit": self._limits[pool_name],
+                "active": self._active[pool_name],
+                "waiting_for_connection": max(0, self._active[pool_name] - self._limits[pool_name]),
+                "saturation": self._active[pool_name] / self._limits[pool_name],
+            }
+            for pool_name in self._sessions
+        }
+
+    async def close(self) -> None:
+        """"""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
 class HttpClient:
     """"""
 
+    # Responses do not depend on the access token: identical GETs of different users are coalesced
+    PUBLIC_API = False
     RETRY_AMOUNT = 5
+    DEFAULT_RETRY_AFTER = 1
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 10
 
-    def __init__(self, session: aiohttp.ClientSession):
+    def __init__(self, session: SessionPool):
         """"""
         self._session = session
-        self.__request_barrier_lock = asyncio.Lock()
-        self.__request_barrier = asyncio.Event()
-        self.__request_barrier.set()
+
+    def _backoff_delay(self, retry: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2**retry))
 
     async def request(
         self,
@@ -52,57 +287,115 @@ class HttpClient:
         data=None,
         params: dict = {},
         headers: dict = {},
+        decoder: JsonDecoder = DEFAULT_DECODER,
+        conditional: bool = False,
     ):
+        """Send a request, retrying it if needed, and return its JSON body decoded by decoder, or its image bytes
+
+        If conditional, a 304 Not Modified is a success, and the body is returned in a ConditionalResponse with
+        the validators of the resource.
+        """
+        host = parse.urlsplit(url).hostname
+        rate_limiter = self._session.rate_limiters.get(host)
         for current_retry in range(self.RETRY_AMOUNT):
-            await self.__request_barrier.wait()
+            if rate_limiter is not None:
+                await rate_limiter.acquire(scope=headers.get("Authorization"))
             request_data = (url, params, headers, data)
-            response = await self._session.request(method=method, url=url, data=data, params=params, headers=headers)
-            try:
-                status = response.status
-                if "application/json" in response.content_type:
-                    data = json.loads(await response.text(encoding="utf-8"))
-                elif "image/jpeg" in response.content_type:
-                    data = await response.read()
+            async with self._session.concurrency_limiter.acquire(host), self._session.session(host) as session:
+                start_time = time.monotonic()
+                response = await session.request(method=method, url=url, data=data, params=params, headers=headers)
+                latency = time.monotonic() - start_time
+                try:
+                    status = response.status
+                    if "application/json" in response.content_type:
+                        # Error bodies do not have the fields of the payload expected by a typed decoder
+                        body_decoder = decoder if 300 > status >= 200 else DEFAULT_DECODER
+                        response_data = body_decoder(await response.read())
+                    elif response.content_type.startswith("image/"):
+                        response_data = await response.read()
+                    else:
+                        response_data = {}
+                finally:
+                    await response.release()
+            if 300 > status >= 200 or (status == 304 and conditional):
+                if rate_limiter is not None:
+                    await rate_limiter.on_success(latency)
+                if conditional:
+                    return ConditionalResponse(
+                        data=response_data if status != 304 else None,
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                        modified=status != 304,
+                    )
+                return response_data
+            if status == 429:  # Rate limited
+                retry_after = float(response.headers.get("Retry-After", self.DEFAULT_RETRY_AFTER))
+                if rate_limiter is not None:
+                    await rate_limiter.on_rate_limited(retry_after)
                 else:
-                    data = {}
-                if 300 > status >= 200:
-                    return data
-                if status == 429:  # Rate limited
-                    self.__request_barrier.clear()
-                    amount = int(response.headers.get("Retry-After"))
-                    checkpoint = int(time.time())
-                    async with self.__request_barrier_lock:
-                        if (int(time.time()) - checkpoint) < amount:
-                            self.__request_barrier.clear()
-                            await asyncio.sleep(int(amount))
-                            self.__request_barrier.set()
-                    continue
-                if status in (502, 503):
-                    continue
-                if status == 401:
-                    raise Unauthorized(response, request_data)
-                if status == 403:
-                    raise Forbidden(response, request_data)
-                if status == 404:
-                    raise NotFound(response, request_data)
-            finally:
-                await response.release()
+                    await asyncio.sleep(retry_after)
+                continue
+            if status in (500, 502, 503, 504):
+                await asyncio.sleep(self._backoff_delay(current_retry))
+                continue
+            if status == 400:
+                raise BadRequest(response, request_data)
+            if status == 401:
+                raise Unauthorized(response, request_data)
+            if status == 403:
+                raise Forbidden(response, request_data)
+            if status == 404:
+                raise NotFound(response, request_data)
         if response.status == 429:
             raise RateLimitedException(response, request_data)
         raise HTTPException(response, request_data)
 
+    def _single_flight_key(self, method: str, url: str, params: dict, headers: dict, decoder: JsonDecoder) -> tuple:
+        """Method, URL and normalized params of the request, its access token unless the API is public, and the
+        decoder since the response is shared decoded"""
+        normalized_params = tuple(sorted((str(key), str(value)) for key, value in params.items()))
+        authorization = None if self.PUBLIC_API else headers.get("Authorization")
+        return (method, url, normalized_params, authorization, decoder)
+
     async def async_get(
         self,
         url: str,
         access_token=None,
-        params: dict = {},
-        headers: dict = {},
+        params: dict = None,
+        headers: dict = None,
+        decoder: JsonDecoder = DEFAULT_DECODER,
     ):
-        """"""
+        """Send a GET request, sharing the response with identical GET requests in flight
+
+        The response can be shared by several callers and must not be modified.
+        """
+        params = params or {}
+        headers = dict(headers or {})
         if access_token:
             token = "Bearer {}".format(access_token)
             headers["Authorization"] = token
-        response = await self.request("GET", url=url, params=params, headers=headers)
+        key = self._single_flight_key("GET", url, params, headers, decoder)
+        response = await self._session.single_flight.do(
+            key, lambda: self.request("GET", url=url, params=params, headers=headers, decoder=decoder)
+        )
+        return response
+
+    async def async_get_conditional(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        access_token=None,
+    ) -> ConditionalResponse:
+        """Send a GET request only returning the body if it changed since the given validators"""
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        if access_token:
+            headers["Authorization"] = "Bearer {}".format(access_token)
+        response = await self.request("GET", url=url, headers=headers, conditional=True)
         return response
 
     async def async_post(
@@ -110,10 +403,12 @@ class HttpClient:
         url: str,
         data=None,
         access_token=None,
-        params: dict = {},
-        headers: dict = {},
+        params: dict = None,
+        headers: dict = None,
     ):
         """"""
+        params = params or {}
+        headers = dict(headers or {})
         if access_token:
             token = "Bearer {}".format(access_token)
             headers["Authorization"] = token
@@ -125,10 +420,12 @@ class HttpClient:
         url: str,
         data=None,
         access_token=None,
-        params: dict = {},
-        headers: dict = {},
+        params: dict = None,
+        headers: dict = None,
     ):
         """"""
+        params = params or {}
+        headers = dict(headers or {})
         if access_token:
             token = "Bearer {}".format(access_token)
             headers["Authorization"] = token
@@ -0,0 +1,54 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+from typing import Callable
+
+
+class ImagePool:
+    """Run the Pillow work (decode, resize, JPEG encode) out of the event loop, in worker processes
+
+    At most max_pending jobs are submitted at once, the others wait without blocking the loop. Without processes
+    (use_processes=False), jobs run in the default thread pool with asyncio.to_thread.
+    """
+
+    MAX_WORKERS = 2
+    MAX_PENDING = 8
+
+    def __init__(self, max_workers: int = None, max_pending: int = None, use_processes: bool = True):
+        """"""
+        self.max_workers = max_workers or self.MAX_WORKERS
+        self.max_pending = max_pending or self.MAX_PENDING
+        self._executor = None
+        if use_processes:
+            # Forking a process running an event loop and threads is unsafe
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        self._running = 0
+        self._queued = 0
+
+    async def run(self, func: Callable, *args):
+        """Run func(*args) in a worker and return its result. func and args must be picklable."""
+        self._queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._queued -= 1
+        self._running += 1
+        try:
+            if self._executor is None:
+                return await asyncio.to_thread(func, *args)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict[str, int]:
+        """Jobs submitted to the workers, and jobs waiting to be submitted"""
+        return {"limit": self.max_pending, "running": self._running, "queued": self._queued}
+
+    def shutdown(self) -> None:
+        """"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
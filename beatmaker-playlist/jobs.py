@@ -0,0 +1,232 @@
+from dataclasses import dataclass, field
+import json
+import time
+from typing import Awaitable, Callable, Optional
+import uuid
+import redis.asyncio as redis
+
+# Take the first queued job whose user runs less than the cap, and mark it as processing until the deadline.
+# Job hashes and running sets are derived from the prefix, so this script expects a single Redis (no cluster).
+# KEYS: queue, processing. ARGV: now (ms), visibility timeout (ms), jobs per user, jobs scanned, prefix
+CLAIM_SCRIPT = """
+local candidates = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[4]) - 1)
+for _, job_id in ipairs(candidates) do
+    local job_key = ARGV[5] .. job_id
+    local user_id = redis.call('HGET', job_key, 'user_id')
+    if not user_id then
+        -- Expired job
+        redis.call('ZREM', KEYS[1], job_id)
+    else
+        local running_key = ARGV[5] .. 'running:' .. user_id
+        if redis.call('SCARD', running_key) < tonumber(ARGV[3]) then
+            redis.call('ZREM', KEYS[1], job_id)
+            redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[2]), job_id)
+            redis.call('SADD', running_key, job_id)
+            redis.call('HINCRBY', job_key, 'attempts', 1)
+            return job_id
+        end
+    end
+end
+return false
+"""
+
+# Queue again the processing jobs past their deadline (their worker died or hung), and return the ones without
+# attempts left.
+# KEYS: queue, processing, sequence. ARGV: now (ms), prefix, priority weight
+REQUEUE_EXPIRED_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+local dead = {}
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], job_id)
+    local job_key = ARGV[2] .. job_id
+    local job = redis.call('HMGET', job_key, 'user_id', 'attempts', 'max_attempts', 'priority')
+    if job[1] then
+        redis.call('SREM', ARGV[2] .. 'running:' .. job[1], job_id)
+        if tonumber(job[2]) < tonumber(job[3]) then
+            local sequence = redis.call('INCR', KEYS[3])
+            redis.call('ZADD', KEYS[1], tonumber(job[4]) * tonumber(ARGV[3]) + sequence, job_id)
+        else
+            table.insert(dead, job_id)
+        end
+    end
+end
+return dead
+"""
+
+
+@dataclass(slots=True)
+class Job:
+    """A task of a user, run by a worker with the Spotify credentials of the user"""
+
+    kind: str
+    user_id: str
+    task_id: str
+    args: dict
+    credentials: dict
+    priority: int = 0
+    max_attempts: int = 3
+    attempts: int = 0
+    # Progress recorded by the previous attempts, to resume from it
+    checkpoint: dict = field(default_factory=dict)
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+
+class Checkpoint:
+    """Values a task records as it goes, such as what it already wrote to Spotify, so that running it again
+    resumes from them instead of repeating its side effects"""
+
+    def __init__(self, values: Optional[dict] = None, save: Optional[Callable[[], Awaitable[None]]] = None):
+        """save stores values, which are only kept in memory without it"""
+        self.values = values if values is not None else {}
+        self._save = save
+
+    def get(self, key: str, default=None):
+        """"""
+        return self.values.get(key, default)
+
+    async def set(self, **values) -> None:
+        """"""
+        self.values.update(values)
+        if self._save is not None:
+            await self._save()
+
+
+class JobQueue:
+    """Redis queue of jobs, by priority (lowest first) then enqueue time
+
+    A claimed job stays invisible to other workers until its visibility deadline, which its worker extends
+    while running it. Past the deadline, the job is queued again, until max_attempts. A user runs at most
+    MAX_JOBS_PER_USER jobs at once.
+    """
+
+    PREFIX = "jobs:"
+    PRIORITY_BUILD = 0
+    PRIORITY_REFRESH = 1
+    VISIBILITY_TIMEOUT = 60
+    MAX_JOBS_PER_USER = 2
+    # Jobs of users at their cap are skipped, among the first CLAIM_SCAN queued jobs
+    CLAIM_SCAN = 100
+    # Jobs expire if no worker takes them
+    JOB_TTL = 24 * 3600
+    # Scores are priority * PRIORITY_WEIGHT + sequence number, to keep the enqueue order within a priority
+    PRIORITY_WEIGHT = 10**13
+
+    def __init__(self, redis_client: redis.Redis, visibility_timeout: int = None, max_jobs_per_user: int = None):
+        """"""
+        self._redis = redis_client
+        self.visibility_timeout = visibility_timeout or self.VISIBILITY_TIMEOUT
+        self.max_jobs_per_user = max_jobs_per_user or self.MAX_JOBS_PER_USER
+        self._queue_key = f"{self.PREFIX}queue"
+        self._processing_key = f"{self.PREFIX}processing"
+        self._sequence_key = f"{self.PREFIX}sequence"
+        self._claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self._requeue_expired_script = redis_client.register_script(REQUEUE_EXPIRED_SCRIPT)
+
+    def _job_key(self, job_id: str) -> str:
+        """"""
+        return f"{self.PREFIX}{job_id}"
+
+    def _running_key(self, user_id: str) -> str:
+        """"""
+        return f"{self.PREFIX}running:{user_id}"
+
+    async def _score(self, priority: int) -> int:
+        """"""
+        return priority * self.PRIORITY_WEIGHT + await self._redis.incr(self._sequence_key)
+
+    async def enqueue(self, job: Job) -> str:
+        """"""
+        job_key = self._job_key(job.id)
+        score = await self._score(job.priority)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                job_key,
+                mapping={
+                    "kind": job.kind,
+                    "user_id": job.user_id,
+                    "task_id": job.task_id,
+                    "args": json.dumps(job.args),
+                    "credentials": json.dumps(job.credentials),
+                    "priority": job.priority,
+                    "max_attempts": job.max_attempts,
+                    "attempts": job.attempts,
+                    "checkpoint": json.dumps(job.checkpoint),
+                },
+            )
+            pipe.expire(job_key, self.JOB_TTL)
+            pipe.zadd(self._queue_key, {job.id: score})
+            await pipe.execute()
+        return job.id
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        """"""
+        fields = await self._redis.hgetall(self._job_key(job_id))
+        if not fields:
+            return None
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        return Job(
+            kind=fields["kind"],
+            user_id=fields["user_id"],
+            task_id=fields["task_id"],
+            args=json.loads(fields["args"]),
+            credentials=json.loads(fields["credentials"]),
+            priority=int(fields["priority"]),
+            max_attempts=int(fields["max_attempts"]),
+            attempts=int(fields["attempts"]),
+            checkpoint=json.loads(fields.get("checkpoint", "{}")),
+            id=job_id,
+        )
+
+    async def claim(self) -> Optional[Job]:
+        """Take the next job allowed to run, or return None"""
+        now = int(time.time() * 1000)
+        args = [now, self.visibility_timeout * 1000, self.max_jobs_per_user, self.CLAIM_SCAN, self.PREFIX]
+        job_id = await self._claim_script(keys=[self._queue_key, self._processing_key], args=args)
+        if job_id is None:
+            return None
+        return await self.load(job_id.decode())
+
+    async def extend(self, job: Job) -> bool:
+        """Push back the visibility deadline of a running job. False if the job was queued again meanwhile."""
+        deadline = int(time.time() * 1000) + self.visibility_timeout * 1000
+        updated = await self._redis.zadd(self._processing_key, {job.id: deadline}, xx=True, ch=True)
+        return bool(updated)
+
+    async def save_checkpoint(self, job: Job) -> None:
+        """Store the checkpoint of a running job, for its next attempts"""
+        await self._redis.hset(self._job_key(job.id), "checkpoint", json.dumps(job.checkpoint))
+
+    async def complete(self, job: Job) -> None:
+        """Remove a finished job, successful or not"""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._processing_key, job.id)
+            pipe.srem(self._running_key(job.user_id), job.id)
+            pipe.delete(self._job_key(job.id))
+            await pipe.execute()
+
+    async def retry(self, job: Job) -> None:
+        """Queue a failed job again"""
+        score = await self._score(job.priority)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._processing_key, job.id)
+            pipe.srem(self._running_key(job.user_id), job.id)
+            pipe.zadd(self._queue_key, {job.id: score})
+            await pipe.execute()
+
+    async def requeue_expired(self) -> list[Job]:
+        """Queue again the jobs whose worker stopped extending them, and return the ones without attempts left"""
+        now = int(time.time() * 1000)
+        dead_job_ids = await self._requeue_expired_script(
+            keys=[self._queue_key, self._processing_key, self._sequence_key],
+            args=[now, self.PREFIX, self.PRIORITY_WEIGHT],
+        )
+        dead_jobs = [await self.load(job_id.decode()) for job_id in dead_job_ids]
+        return [job for job in dead_jobs if job is not None]
+
+    async def stats(self) -> dict[str, int]:
+        """"""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(self._queue_key)
+            pipe.zcard(self._processing_key)
+            queued, processing = await pipe.execute()
+        return {"queued": queued, "processing": processing}
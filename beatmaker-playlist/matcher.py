@@ -0,0 +1,96 @@
+from collections import Counter
+from typing import Optional
+
+from utils import Track, normalize_string
+
+
+class _Letters:
+    """Letter multiset of a normalized string, as compared by textdistance with qval=1"""
+
+    __slots__ = ("string", "counts", "length")
+
+    def __init__(self, string: str):
+        self.string = string
+        self.counts = Counter(string)
+        self.length = len(string)
+
+    def similarities(self, other: "_Letters") -> tuple[float, float]:
+        """Jaccard and overlap similarities, identical to textdistance.jaccard and textdistance.overlap"""
+        if self.string == other.string:
+            return 1, 1
+        if not self.length or not other.length:
+            return 0, 0
+        # Iterate over the smallest alphabet
+        small, large = (self, other) if len(self.counts) <= len(other.counts) else (other, self)
+        large_counts = large.counts
+        intersection = 0
+        for letter, count in small.counts.items():
+            large_count = large_counts.get(letter)
+            if large_count:
+                intersection += count if count < large_count else large_count
+        union = self.length + other.length - intersection
+        return intersection / union, intersection / min(self.length, other.length)
+
+
+class TrackMatcher:
+    """Match candidate tracks against one Genius track, normalizing every string only once"""
+
+    MAX_ARTIST_DISTANCE = 0.3
+    MAX_TITLE_DISTANCE = 0.5
+    MAX_OVERLAP_DISTANCE = 0.3
+
+    def __init__(self, track: Track):
+        """"""
+        self.track = track
+        self._letters_cache: dict[str, _Letters] = {}
+        self._artist = _Letters(track.normalized.artist)
+        self._title = _Letters(track.normalized.title)
+        # Length ratio under which the Jaccard distance can't be small enough
+        self._min_artist_ratio = 1 - self.MAX_ARTIST_DISTANCE - 1e-9
+        self._min_title_ratio = 1 - self.MAX_TITLE_DISTANCE - 1e-9
+
+    def _letters(self, string: str) -> _Letters:
+        """"""
+        letters = self._letters_cache.get(string)
+        if letters is None:
+            letters = self._letters_cache[string] = _Letters(normalize_string(string))
+        return letters
+
+    @staticmethod
+    def _length_ratio(first: _Letters, second: _Letters) -> float:
+        """Upper bound of the Jaccard similarity of two strings"""
+        longest = max(first.length, second.length)
+        return min(first.length, second.length) / longest if longest else 1
+
+    def _title_matches(self, title: _Letters) -> bool:
+        """"""
+        if self._length_ratio(self._title, title) < self._min_title_ratio:
+            return False
+        jaccard, overlap = self._title.similarities(title)
+        return (1 - overlap <= self.MAX_OVERLAP_DISTANCE) & (1 - jaccard <= self.MAX_TITLE_DISTANCE)
+
+    def _artist_matches(self, artist: _Letters) -> bool:
+        """"""
+        if self._length_ratio(self._artist, artist) < self._min_artist_ratio:
+            return False
+        jaccard, overlap = self._artist.similarities(artist)
+        return (1 - overlap <= self.MAX_OVERLAP_DISTANCE) & (1 - jaccard <= self.MAX_ARTIST_DISTANCE)
+
+    def matches(self, item_track: Track) -> bool:
+        """"""
+        return self._title_matches(self._letters(item_track.title)) and self._artist_matches(
+            self._letters(item_track.artist)
+        )
+
+    def find(self, items: list[dict]) -> Optional[tuple[str, Track]]:
+        """Return the id and track of the first Spotify search item matching the track, if any"""
+        for item in items:
+            item_title = item.get("name")
+            # The title is shared by every artist of the item, so it is only scored once
+            if not self._title_matches(self._letters(item_title)):
+                continue
+            for item_artist in item.get("artists", []):
+                item_artist_name = item_artist.get("name")
+                if self._artist_matches(self._letters(item_artist_name)):
+                    return item.get("id"), Track(item_artist_name, item_title)
+        return None
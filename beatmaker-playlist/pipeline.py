@@ -0,0 +1,62 @@
+import asyncio
+from collections import deque
+import contextlib
+from typing import AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_END = object()
+
+
+async def buffered(source: AsyncGenerator[T, None], maxsize: int) -> AsyncIterator[T]:
+    """Consume the source in a background task, keeping at most maxsize items ahead of the reader
+
+    The source is closed when the reader stops early.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
+        # A producer cancelled by the reader stopping early must not wait for a free slot to signal the end
+        async with contextlib.aclosing(source):
+            try:
+                async for item in source:
+                    await queue.put(item)
+            except Exception:
+                await queue.put(_END)
+                raise
+        await queue.put(_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not _END:
+            yield item
+        # Re-raise an exception from the source, if any
+        await producer
+    finally:
+        # Wait for the source to be closed, without raising its exception again
+        producer.cancel()
+        await asyncio.wait([producer])
+        if not producer.cancelled():
+            producer.exception()
+
+
+async def imap(source: AsyncIterable[T], func: Callable[[T], Awaitable[R]], concurrency: int) -> AsyncIterator[R]:
+    """Apply func to each item with at most concurrency calls running, yielding results in source order"""
+    pending: deque[asyncio.Task] = deque()
+    try:
+        async for item in source:
+            pending.append(asyncio.create_task(func(item)))
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def from_iterable(items: Iterable[T]) -> AsyncIterator[T]:
+    """Turn a regular iterable into an async one, to feed it to a pipeline stage"""
+    for item in items:
+        yield item
@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from typing import Optional
+import redis.asyncio as redis
+
+# Store the Genius name and id of each producer under its lowercase name, and mark the name as seen. A name found
+# with another id than the stored one is made ambiguous: it no longer resolves, the producer is searched instead.
+# KEYS: names, seen. ARGV: now, ambiguous value, then lowercase name, value [name, id] and id triples
+INDEX_NAMES_SCRIPT = """
+for i = 3, #ARGV, 3 do
+    local name, value, id = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    local current = redis.call('HGET', KEYS[1], name)
+    if current == ARGV[2] or (current and cjson.decode(current)[2] ~= id) then
+        value = ARGV[2]
+    end
+    redis.call('HSET', KEYS[1], name, value)
+    redis.call('ZADD', KEYS[2], ARGV[1], name)
+end
+"""
+
+
+class ProducerIndex:
+    """Producers of the Genius songs fetched by the process, indexed in Redis by lowercase name, with the songs
+    they produced
+
+    Songs are queued as they are fetched and written in batches by a background task, so indexing never delays
+    a build. A full queue drops songs, they are indexed the next time they are fetched.
+
+    Builds only read the names. The songs of each producer are stored for tools and future lookups.
+    """
+
+    PREFIX = "producer-index:"
+    MAX_PENDING = 10_000
+    BATCH_SIZE = 200
+    # Names and songs of the producers not seen for this long are removed
+    TTL = 30 * 24 * 3600
+    PRUNE_INTERVAL = 3600
+    # Value of the names shared by several producers
+    AMBIGUOUS = ""
+
+    def __init__(self, redis_client: redis.Redis, max_pending: int = None):
+        """"""
+        self._redis = redis_client
+        self._names_key = f"{self.PREFIX}names"
+        # Sorted set of the lowercase names, scored by last time seen
+        self._seen_key = f"{self.PREFIX}seen"
+        self._index_names_script = redis_client.register_script(INDEX_NAMES_SCRIPT)
+        self._last_prune = 0.0
+        self._pending: asyncio.Queue = asyncio.Queue(max_pending or self.MAX_PENDING)
+        self._crawler = None
+        self.hits = 0
+        self.misses = 0
+        self.indexed = 0
+        self.dropped = 0
+
+    def _songs_key(self, producer_id: int) -> str:
+        """"""
+        return f"{self.PREFIX}songs:{producer_id}"
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        """Same comparison as the search of Genius.get_producer_id"""
+        return name.lower()
+
+    def add(self, song: dict) -> None:
+        """Queue a Genius.song_projection() for indexing"""
+        if not song["producer_artists"]:
+            return
+        if self._crawler is None:
+            self._crawler = asyncio.create_task(self._crawl())
+        try:
+            self._pending.put_nowait(song)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _crawl(self) -> None:
+        """Write the queued songs to the index, in a single round trip for each batch"""
+        while True:
+            songs = [await self._pending.get()]
+            while len(songs) < self.BATCH_SIZE and not self._pending.empty():
+                songs.append(self._pending.get_nowait())
+            try:
+                await self._write(songs)
+                self.indexed += len(songs)
+            except Exception as e:
+                logging.error(f"Failed to index {len(songs)} songs: {e}")
+            try:
+                if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL:
+                    self._last_prune = time.monotonic()
+                    await self._prune()
+            except Exception as e:
+                logging.error(f"Failed to prune the producer index: {e}")
+            finally:
+                # Songs are done once indexed and the index pruned, for close() to wait for both
+                for _ in songs:
+                    self._pending.task_done()
+
+    async def _write(self, songs: list[dict]) -> None:
+        """"""
+        names: dict[str, tuple[str, int]] = {}
+        producer_songs: dict[int, dict] = {}
+        for song in songs:
+            metadata = json.dumps({"title": song["title"], "primary_artist": song["primary_artist"]})
+            for producer in song["producer_artists"]:
+                name = self.normalize_name(producer["name"])
+                if name in names and names[name][1] != producer["id"]:
+                    names[name] = (self.AMBIGUOUS, 0)
+                else:
+                    names[name] = (json.dumps([producer["name"], producer["id"]]), producer["id"])
+                producer_songs.setdefault(producer["id"], {})[song["id"]] = metadata
+        args = [time.time(), self.AMBIGUOUS]
+        for name, (value, producer_id) in names.items():
+            args += [name, value, producer_id]
+        async with self._redis.pipeline(transaction=False) as pipe:
+            await self._index_names_script(keys=[self._names_key, self._seen_key], args=args, client=pipe)
+            for producer_id, mapping in producer_songs.items():
+                pipe.hset(self._songs_key(producer_id), mapping=mapping)
+                pipe.expire(self._songs_key(producer_id), self.TTL)
+            await pipe.execute()
+
+    async def _prune(self) -> None:
+        """Remove the names not seen for TTL, the songs of their producers expire on their own"""
+        expired_names = await self._redis.zrangebyscore(self._seen_key, "-inf", time.time() - self.TTL)
+        if expired_names:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.hdel(self._names_key, *expired_names)
+                pipe.zrem(self._seen_key, *expired_names)
+                await pipe.execute()
+            logging.info(f"{len(expired_names)} producers removed from index")
+
+    async def get_producer(self, name: str) -> Optional[tuple[str, int]]:
+        """Return the Genius name and id of the producer, or None if not indexed"""
+        value = await self._redis.hget(self._names_key, self.normalize_name(name))
+        if value is None or value.decode() == self.AMBIGUOUS:
+            self.misses += 1
+            return None
+        self.hits += 1
+        producer_name, producer_id = json.loads(value)
+        return producer_name, producer_id
+
+    async def get_songs(self, producer_id: int) -> dict[int, dict]:
+        """Return the title and primary artist of the indexed songs of the producer, by song id"""
+        songs = await self._redis.hgetall(self._songs_key(producer_id))
+        return {int(song_id): json.loads(metadata) for song_id, metadata in songs.items()}
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "indexed": self.indexed,
+            "dropped": self.dropped,
+            "pending": self._pending.qsize(),
+        }
+
+    async def close(self) -> None:
+        """Index the queued songs, then stop the background task"""
+        if self._crawler is not None:
+            await self._pending.join()
+            self._crawler.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._crawler
+            self._crawler = None
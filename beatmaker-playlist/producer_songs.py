@@ -0,0 +1,206 @@
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+import uuid
+import redis.asyncio as redis
+
+from progress import SongsProgress
+from utils import Match, Track
+
+# Delete the lock only if it is still held by this build
+# KEYS: lock. ARGV: token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+@dataclass
+class ProducerSongs:
+    """Songs of a producer on Genius, split by whether the producer is credited, and their Spotify matches in a
+    market"""
+
+    beatmaker_name: str
+    beatmaker_id: int
+    song_ids: list[int]
+    songs_produced: list[Track]
+    songs_not_produced: list[Track]
+    matches: list[Match]
+
+    def to_json(self) -> str:
+        """"""
+        return json.dumps(
+            {
+                "beatmaker_name": self.beatmaker_name,
+                "beatmaker_id": self.beatmaker_id,
+                "song_ids": self.song_ids,
+                "songs_produced": [[track.artist, track.title] for track in self.songs_produced],
+                "songs_not_produced": [[track.artist, track.title] for track in self.songs_not_produced],
+                "matches": [[match.track.artist, match.track.title, match.id] for match in self.matches],
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "ProducerSongs":
+        """"""
+        value = json.loads(raw)
+        return cls(
+            beatmaker_name=value["beatmaker_name"],
+            beatmaker_id=value["beatmaker_id"],
+            song_ids=value["song_ids"],
+            songs_produced=[Track(artist, title) for artist, title in value["songs_produced"]],
+            songs_not_produced=[Track(artist, title) for artist, title in value["songs_not_produced"]],
+            matches=[Match(Track(artist, title), id) for artist, title, id in value["matches"]],
+        )
+
+
+class SharedProducerSongs:
+    """Build the ProducerSongs of a producer and market once for every user asking for them within WINDOW
+
+    Concurrent builds of the same producer join the one in flight: in the process through a shared task, and
+    across processes through a Redis lock held by the building process, the others waiting for its result.
+    The songs counts of the build are published in Redis, for every caller to follow them.
+    """
+
+    PREFIX = "producer-songs:"
+    # Seconds a result is reused, new songs of the producer are missed meanwhile
+    WINDOW = 10 * 60
+    # The lock is extended while the build runs, and expires if its process dies
+    LOCK_TTL = 30
+    POLL_INTERVAL = 0.5
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, redis_client: redis.Redis, window: int = None):
+        """"""
+        self._redis = redis_client
+        self.window = window or self.WINDOW
+        self._builds: dict[str, asyncio.Task] = {}
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self.hits = 0
+        self.builds = 0
+        self.joined = 0
+        self.waited = 0
+
+    def _key(self, beatmaker_id: int, market: Optional[str]) -> str:
+        """"""
+        return f"{self.PREFIX}{market}:{beatmaker_id}"
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Task) -> None:
+        """Mark the exception of a build as retrieved, even if every waiter was cancelled"""
+        if not task.cancelled():
+            task.exception()
+
+    async def get_or_build(
+        self,
+        beatmaker_id: int,
+        market: Optional[str],
+        build: Callable[[SongsProgress], Awaitable[ProducerSongs]],
+        progress: Optional[SongsProgress] = None,
+    ) -> ProducerSongs:
+        """Return the songs of the producer in the market, from a recent or in flight build if any, calling
+        build otherwise, with the SongsProgress it must update
+
+        progress follows the songs counts of the build, whichever caller or process runs it.
+        """
+        key = self._key(beatmaker_id, market)
+        follower = None
+        if progress is not None:
+            follower = asyncio.create_task(self._follow_progress(key, progress))
+        try:
+            return await self._join_or_build(key, build)
+        finally:
+            if follower is not None:
+                follower.cancel()
+
+    async def _join_or_build(
+        self, key: str, build: Callable[[SongsProgress], Awaitable[ProducerSongs]]
+    ) -> ProducerSongs:
+        """"""
+        task = self._builds.get(key)
+        if task is not None:
+            self.joined += 1
+            try:
+                return await asyncio.shield(task)
+            except Exception as e:
+                # The build of another user may have failed because of their credentials
+                logging.warning(f"Shared build {key} failed, building it again: {e}")
+        task = asyncio.ensure_future(self._get_or_build(key, build))
+        self._builds[key] = task
+        task.add_done_callback(lambda _: self._builds.pop(key) if self._builds.get(key) is task else None)
+        task.add_done_callback(self._retrieve_exception)
+        # A cancelled build must not cancel the one shared with the others
+        return await asyncio.shield(task)
+
+    async def _get_or_build(
+        self, key: str, build: Callable[[SongsProgress], Awaitable[ProducerSongs]]
+    ) -> ProducerSongs:
+        """"""
+        lock_key = f"{key}:lock"
+        token = str(uuid.uuid4())
+        waited = False
+        while True:
+            raw_value = await self._redis.get(key)
+            if raw_value is not None:
+                self.hits += 1
+                return ProducerSongs.from_json(raw_value)
+            if await self._redis.set(lock_key, token, nx=True, ex=self.LOCK_TTL):
+                break
+            # Another process is building it
+            if not waited:
+                waited = True
+                self.waited += 1
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        self.builds += 1
+        progress = SongsProgress()
+        keep_locked = asyncio.create_task(self._keep_locked(lock_key, token))
+        publisher = asyncio.create_task(self._publish_progress(key, progress))
+        try:
+            producer_songs = await build(progress)
+            await self._redis.set(key, producer_songs.to_json(), ex=self.window)
+            return producer_songs
+        finally:
+            keep_locked.cancel()
+            publisher.cancel()
+            await self._redis.delete(f"{key}:progress")
+            await self._release_script(keys=[lock_key], args=[token])
+
+    async def _publish_progress(self, key: str, progress: SongsProgress) -> None:
+        """Store the songs counts of the build every PROGRESS_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            counts = json.dumps([progress.songs_found, progress.songs_done])
+            await self._redis.set(f"{key}:progress", counts, ex=self.LOCK_TTL)
+
+    async def _follow_progress(self, key: str, progress: SongsProgress) -> None:
+        """Copy the songs counts of the build in progress every PROGRESS_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            counts = await self._redis.get(f"{key}:progress")
+            if counts is not None:
+                progress.songs_found, progress.songs_done = json.loads(counts)
+
+    async def _keep_locked(self, lock_key: str, token: str) -> None:
+        """Extend the lock while the build runs"""
+        while True:
+            await asyncio.sleep(self.LOCK_TTL / 3)
+            if await self._redis.get(lock_key) != token.encode():
+                logging.warning(f"Lock {lock_key} was lost while building")
+                return
+            await self._redis.expire(lock_key, self.LOCK_TTL)
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {
+            "hits": self.hits,
+            "builds": self.builds,
+            "joined": self.joined,
+            "waited": self.waited,
+            "in_flight": len(self._builds),
+        }
@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from typing import Optional
+import redis.asyncio as redis
+
+
+class ProgressHub:
+    """Forward the task events published in Redis to the watchers of this process
+
+    The process holds a single pattern subscription, whatever the number of watchers, and fans out each event
+    to the queues watching its task.
+    """
+
+    CHANNEL_PREFIX = "task-events"
+    RECONNECT_DELAY = 1
+
+    def __init__(self, redis_client: redis.Redis):
+        """"""
+        self._redis = redis_client
+        self._watchers: dict[str, set[asyncio.Queue]] = {}
+        self._subscribed = asyncio.Event()
+        self._listener = None
+
+    @classmethod
+    def channel(cls, user_id: str, task_id: str) -> str:
+        """"""
+        return f"{cls.CHANNEL_PREFIX}:{user_id}:{task_id}"
+
+    async def _listen(self) -> None:
+        """Dispatch the events of every task to their watchers, subscribing again if the connection is lost"""
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.psubscribe(f"{self.CHANNEL_PREFIX}:*")
+                self._subscribed.set()
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"].decode()
+                    watchers = self._watchers.get(channel)
+                    if watchers:
+                        event = json.loads(message["data"])
+                        for queue in watchers:
+                            queue.put_nowait(event)
+            except Exception as e:
+                logging.error(f"Task events subscription lost: {e}")
+                await asyncio.sleep(self.RECONNECT_DELAY)
+            finally:
+                self._subscribed.clear()
+                await pubsub.aclose()
+
+    @contextlib.asynccontextmanager
+    async def watch(self, user_id: str, task_id: str):
+        """Yield a queue receiving the events of the task, from the moment this block is entered"""
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        await self._subscribed.wait()
+        channel = self.channel(user_id, task_id)
+        queue = asyncio.Queue()
+        self._watchers.setdefault(channel, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            self._watchers[channel].discard(queue)
+            if not self._watchers[channel]:
+                del self._watchers[channel]
+
+    def stats(self) -> dict[str, int]:
+        """"""
+        return {"tasks": len(self._watchers), "watchers": sum(len(queues) for queues in self._watchers.values())}
+
+    async def close(self) -> None:
+        """"""
+        if self._listener is not None:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+
+
+class SongsProgress:
+    """Songs of a streamed build, counted when listed on Genius and when done (not produced, or searched on
+    Spotify), with the live throughput and the estimated remaining time"""
+
+    # Weight of the last interval in the smoothed throughput
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self):
+        """"""
+        self.songs_found = 0
+        self.songs_done = 0
+        self.rate: Optional[float] = None
+        self._last_sample_time = time.monotonic()
+        self._last_sample_done = 0
+
+    def fraction(self) -> float:
+        """"""
+        return self.songs_done / self.songs_found if self.songs_found else 0.0
+
+    def eta(self) -> Optional[float]:
+        """Seconds left at the current throughput, for the songs found so far"""
+        if not self.rate:
+            return None
+        return (self.songs_found - self.songs_done) / self.rate
+
+    def sample(self) -> None:
+        """Update the throughput with the songs done since the last sample"""
+        now = time.monotonic()
+        elapsed = now - self._last_sample_time
+        if elapsed <= 0:
+            return
+        rate = (self.songs_done - self._last_sample_done) / elapsed
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = self.RATE_SMOOTHING * rate + (1 - self.RATE_SMOOTHING) * self.rate
+        self._last_sample_time = now
+        self._last_sample_done = self.songs_done
+
+    def details(self) -> dict:
+        """"""
+        eta = self.eta()
+        return {
+            "songs_found": self.songs_found,
+            "songs_done": self.songs_done,
+            "rate": round(self.rate, 1) if self.rate is not None else None,
+            "eta": round(eta) if eta is not None else None,
+        }
@@ -0,0 +1,304 @@
+import asyncio
+import contextlib
+import hashlib
+import time
+from typing import Optional
+import redis.asyncio as redis
+
+# Refill every bucket in KEYS (the API bucket first, then optionally the scope bucket) using the Redis clock,
+# apply the successes counted since the last call to the shared rate, and take a token from every bucket.
+# Returns {seconds to wait before trying again (0 if a token was taken), current rate}.
+# ARGV: initial rate, min rate, max rate, burst, increase, successes, scope rate, scope burst, ttl
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local api = KEYS[1]
+local rate = tonumber(redis.call('HGET', api, 'rate') or ARGV[1])
+local successes = tonumber(ARGV[6])
+if successes > 0 then
+    rate = math.min(tonumber(ARGV[3]), rate + successes * tonumber(ARGV[5]) / rate)
+end
+redis.call('HSET', api, 'rate', tostring(rate))
+local paused_until = tonumber(redis.call('HGET', api, 'paused_until') or '0')
+if now < paused_until then
+    return {tostring(paused_until - now), tostring(rate)}
+end
+local rates = {rate, tonumber(ARGV[7])}
+local bursts = {tonumber(ARGV[4]), tonumber(ARGV[8])}
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local last = tonumber(redis.call('HGET', key, 'last') or now)
+    local bucket_tokens = tonumber(redis.call('HGET', key, 'tokens') or bursts[i])
+    tokens[i] = math.min(bursts[i], bucket_tokens + (now - last) * rates[i])
+    if tokens[i] < 1 then
+        wait = math.max(wait, (1 - tokens[i]) / rates[i])
+    end
+end
+for i, key in ipairs(KEYS) do
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'last', tostring(now))
+    redis.call('EXPIRE', key, tonumber(ARGV[9]))
+end
+return {tostring(wait), tostring(rate)}
+"""
+
+# Multiply the shared rate by a factor (at most once per decrease interval) and pause the API.
+# ARGV: initial rate, min rate, factor, decrease interval, pause seconds, ttl
+DECREASE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local api = KEYS[1]
+local rate = tonumber(redis.call('HGET', api, 'rate') or ARGV[1])
+local last_decrease = tonumber(redis.call('HGET', api, 'last_decrease') or '0')
+if now - last_decrease >= tonumber(ARGV[4]) then
+    rate = math.max(tonumber(ARGV[2]), rate * tonumber(ARGV[3]))
+    redis.call('HSET', api, 'rate', tostring(rate), 'last_decrease', tostring(now))
+end
+local pause = tonumber(ARGV[5])
+if pause > 0 then
+    local paused_until = tonumber(redis.call('HGET', api, 'paused_until') or '0')
+    redis.call('HSET', api, 'paused_until', tostring(math.max(paused_until, now + pause)), 'tokens', '0')
+end
+redis.call('EXPIRE', api, tonumber(ARGV[6]))
+return tostring(rate)
+"""
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate adapts to the API: additive increase on success, multiplicative decrease on 429
+
+    Responses slower than target_latency also decrease the rate, at most once per decrease_interval.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        burst: int,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_decrease: float = 0.9,
+        target_latency: float = 2.0,
+        decrease_interval: float = 1.0,
+    ):
+        """"""
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_decrease = latency_decrease
+        self.target_latency = target_latency
+        self.decrease_interval = decrease_interval
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self.rate_limited_responses = 0
+
+    def _refill(self, now: float) -> None:
+        """"""
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self, scope: Optional[str] = None) -> None:
+        """Wait until a request can be sent. The scope (access token) is only limited by RedisRateLimiter."""
+        start = time.monotonic()
+        # The lock makes waiting requests go out in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.throttled_seconds += waited
+            self.throttled_requests += 1
+
+    def _decrease_rate(self, factor: float, now: float) -> None:
+        """"""
+        if now - self._last_decrease >= self.decrease_interval:
+            self.rate = max(self.min_rate, self.rate * factor)
+            self._last_decrease = now
+
+    async def on_success(self, latency: float) -> None:
+        """"""
+        now = time.monotonic()
+        if latency > self.target_latency:
+            self._decrease_rate(self.latency_decrease, now)
+        else:
+            # About `increase` more requests per second, every second
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    async def on_rate_limited(self, retry_after: float) -> None:
+        """Slow down, and pause every request to the API for retry_after seconds"""
+        now = time.monotonic()
+        self.rate_limited_responses += 1
+        self._decrease_rate(self.decrease, now)
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._tokens = 0
+
+    def stats(self) -> dict:
+        """Current rate, and time spent throttled summed over every request"""
+        return {
+            "rate": round(self.rate, 2),
+            "paused": time.monotonic() < self._paused_until,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "throttled_requests": self.throttled_requests,
+            "rate_limited_responses": self.rate_limited_responses,
+        }
+
+
+class RedisRateLimiter(AdaptiveRateLimiter):
+    """AdaptiveRateLimiter whose bucket, rate and 429 pause live in Redis, shared by every worker process
+
+    Each scope (Spotify access token) also gets its own bucket of scope_rate requests per second.
+    """
+
+    KEY_TTL = 3600
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        name: str,
+        scope_rate: Optional[float] = None,
+        scope_burst: Optional[int] = None,
+        **kwargs,
+    ):
+        """"""
+        super().__init__(**kwargs)
+        self._key = f"ratelimit:{name}"
+        self.scope_rate = scope_rate
+        self.scope_burst = scope_burst
+        self._acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._decrease_script = redis_client.register_script(DECREASE_SCRIPT)
+        # Successes not yet applied to the shared rate, sent with the next acquire
+        self._successes = 0
+        # Bucket key -> [lock, number of requests holding or waiting for it]
+        self._queues: dict[str, list] = {}
+
+    def _scope_key(self, scope: str) -> str:
+        """"""
+        return f"{self._key}:scope:{hashlib.sha256(scope.encode()).hexdigest()[:32]}"
+
+    @contextlib.asynccontextmanager
+    async def _queue(self, key: str):
+        """Hold the lock of the bucket, so only the first waiting request of the process polls Redis for it"""
+        queue = self._queues.setdefault(key, [asyncio.Lock(), 0])
+        queue[1] += 1
+        try:
+            async with queue[0]:
+                yield
+        finally:
+            queue[1] -= 1
+            if not queue[1]:
+                del self._queues[key]
+
+    async def acquire(self, scope: Optional[str] = None) -> None:
+        """Wait until a request can be sent without exceeding the budget of the API, nor the one of the scope
+
+        Requests wait in arrival order behind a lock per scope, so a throttled access token does not hold back
+        the others.
+        """
+        start = time.monotonic()
+        keys = [self._key]
+        if scope and self.scope_rate:
+            keys.append(self._scope_key(scope))
+        async with self._queue(keys[-1]):
+            await self._acquire(keys)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.throttled_seconds += waited
+            self.throttled_requests += 1
+
+    async def _acquire(self, keys: list[str]) -> None:
+        """Take a token from every bucket of keys, polling Redis until there is one"""
+        while True:
+            successes, self._successes = self._successes, 0
+            args = [
+                self.rate,
+                self.min_rate,
+                self.max_rate,
+                self.burst,
+                self.increase,
+                successes,
+                self.scope_rate or 0,
+                self.scope_burst or 0,
+                self.KEY_TTL,
+            ]
+            wait, rate = await self._acquire_script(keys=keys, args=args)
+            self.rate = float(rate)
+            if float(wait) <= 0:
+                return
+            await asyncio.sleep(float(wait))
+
+    async def _decrease(self, factor: float, pause: float) -> None:
+        """"""
+        args = [self.rate, self.min_rate, factor, self.decrease_interval, pause, self.KEY_TTL]
+        self.rate = float(await self._decrease_script(keys=[self._key], args=args))
+
+    async def on_success(self, latency: float) -> None:
+        """"""
+        if latency > self.target_latency:
+            await self._decrease(self.latency_decrease, 0)
+        else:
+            self._successes += 1
+
+    async def on_rate_limited(self, retry_after: float) -> None:
+        """Slow down, and pause every request to the API for retry_after seconds, in every process"""
+        self.rate_limited_responses += 1
+        await self._decrease(self.decrease, retry_after)
+
+
+class RateLimiters:
+    """One adaptive rate limiter per API host, shared by every client of the process
+
+    With a Redis client, the limiters are shared by every process using the same Redis.
+    """
+
+    # Host -> AdaptiveRateLimiter arguments. Other hosts (image CDNs) are not rate limited.
+    HOST_RATE_LIMITS = {
+        "api.genius.com": {"rate": 10, "min_rate": 1, "max_rate": 25, "burst": 10},
+        "api.spotify.com": {"rate": 10, "min_rate": 1, "max_rate": 30, "burst": 20},
+    }
+    # Host -> budget of each access token, only enforced with Redis
+    HOST_SCOPE_RATE_LIMITS = {
+        "api.spotify.com": {"scope_rate": 5, "scope_burst": 10},
+    }
+
+    def __init__(self, host_rate_limits: dict[str, dict] = None, redis_client: Optional[redis.Redis] = None):
+        """"""
+        self.host_rate_limits = host_rate_limits or self.HOST_RATE_LIMITS
+        self._redis = redis_client
+        self._limiters: dict[str, AdaptiveRateLimiter] = {}
+
+    def get(self, host: str) -> Optional[AdaptiveRateLimiter]:
+        """"""
+        if host not in self.host_rate_limits:
+            return None
+        if host not in self._limiters:
+            if self._redis is not None:
+                self._limiters[host] = RedisRateLimiter(
+                    self._redis, host, **self.HOST_SCOPE_RATE_LIMITS.get(host, {}), **self.host_rate_limits[host]
+                )
+            else:
+                self._limiters[host] = AdaptiveRateLimiter(**self.host_rate_limits[host])
+        return self._limiters[host]
+
+    def stats(self) -> dict[str, dict]:
+        """"""
+        return {host: limiter.stats() for host, limiter in self._limiters.items()}
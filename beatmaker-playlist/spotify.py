@@ -1,17 +1,21 @@
 import datetime
-from typing import Optional
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Optional
 from urllib import parse
 import base64
+import hashlib
 import logging
 import json
-import asyncio
-import aiohttp
-import textdistance
-import math
+import time
+import redis.asyncio as redis
 
-from http_client import HttpClient
+from cache import LRUCache, RedisCache, TieredCache
+from decoding import SPOTIFY_SEARCH_DECODER
+from http_client import HttpClient, SessionPool
+from image_pool import ImagePool
+from matcher import TrackMatcher
+from pipeline import imap
 import secret_keys
-from utils import Track, normalize_string, Match, Playlist, resize_image, compress_image
+from utils import Track, Match, Playlist, resize_image, cover_images
 
 
 class Spotify(HttpClient):
@@ -21,19 +25,86 @@ class Spotify(HttpClient):
     SCOPES = "user-read-private user-read-email playlist-modify-public, playlist-modify-public, ugc-image-upload"
     OAUTH_AUTHORIZE_URL = "https://accounts.spotify.com/authorize"
     OAUTH_TOKEN_URL = "https://accounts.spotify.com/api/token"
+    MAX_CONCURRENT_REQUESTS = 10
+    ADD_TRACKS_BATCH_SIZE = 100  # Spotify limit : 100 items per request
+    MATCH_CACHE_TTL = 30 * 24 * 3600
+    MATCH_CACHE_NEGATIVE_TTL = 24 * 3600
+    MATCH_CACHE_MAX_ENTRIES = 500_000
+    MATCH_CACHE_SEARCH_ITEMS = False
+    IMAGE_CACHE_TTL = 30 * 24 * 3600
+    # Each cover entry holds a 256 kB upload and a thumbnail in base64, about 350 kB: 175 MB at most
+    COVER_CACHE_MAX_ENTRIES = 500
+    # Each avatar entry holds a 150x150 JPEG in base64, about 10 kB: 100 MB at most
+    AVATAR_CACHE_MAX_ENTRIES = 10_000
+    # Cached images are used without revalidation during this window
+    IMAGE_FRESHNESS = 24 * 3600
 
-    def __init__(self, session: aiohttp.ClientSession, debug: bool = False, faster_tests: bool = False) -> None:
+    # Shared by every Spotify client of the process
+    _match_lru = LRUCache(maxsize=50_000, ttl=3600)
+
+    def __init__(
+        self,
+        session: SessionPool,
+        debug: bool = False,
+        faster_tests: bool = False,
+        redis_client: Optional[redis.Redis] = None,
+        image_pool: Optional[ImagePool] = None,
+    ) -> None:
         """"""
         super().__init__(session=session)
+        self.image_pool = image_pool or ImagePool(use_processes=False)
         self._access_token_response = None
         self._user = None
         self._debug = debug
         self._faster_tests = faster_tests
+        self.match_cache = None
+        self.cover_cache = None
+        self.avatar_cache = None
+        if redis_client is not None:
+            self.cover_cache = RedisCache(
+                redis_client, "image:cover", ttl=self.IMAGE_CACHE_TTL, max_entries=self.COVER_CACHE_MAX_ENTRIES
+            )
+            self.avatar_cache = RedisCache(
+                redis_client, "image:avatar", ttl=self.IMAGE_CACHE_TTL, max_entries=self.AVATAR_CACHE_MAX_ENTRIES
+            )
+            self.match_cache = TieredCache(
+                self._match_lru,
+                RedisCache(
+                    redis_client,
+                    "spotify:match",
+                    ttl=self.MATCH_CACHE_TTL,
+                    max_entries=self.MATCH_CACHE_MAX_ENTRIES,
+                ),
+            )
 
     def set_access_token_response(self, access_token_response: dict) -> dict:
         """"""
         self._access_token_response = access_token_response
 
+    def set_user_profile(self, user: dict) -> None:
+        """"""
+        self._user = user
+
+    @property
+    def access_token_response(self) -> Optional[dict]:
+        """"""
+        return self._access_token_response
+
+    @property
+    def user_profile(self) -> Optional[dict]:
+        """"""
+        return self._user
+
+    @property
+    def user_id(self) -> Optional[str]:
+        """"""
+        return self._user.get("id") if self._user else None
+
+    @property
+    def market(self) -> Optional[str]:
+        """Country of the user, where searched tracks must be available"""
+        return self._user.get("country") if self._user else None
+
     def get_authorize_url(self) -> str:
         """"""
         payload = {
@@ -81,29 +152,89 @@ class Spotify(HttpClient):
         largest_image = max(profile_images, key=lambda img: img.get("height", 0))
         largest_image_url = largest_image.get("url", "")
         logging.info(f"Downloading profile image at {largest_image_url}")
-        profile_image_bytes = await self.async_get(url=largest_image_url)
-        profile_image_bytes_resized = resize_image(profile_image_bytes, width=150, height=150)
-        profile_image_b64_str = base64.b64encode(profile_image_bytes_resized).decode("utf-8")
-        profile_image = f"data:image/jpeg;base64,{profile_image_b64_str}"
-        return profile_image
 
-    async def build_song_id_list(self, tracks: list[Track]) -> list[Match]:
-        """"""
-        coros = []
-        for track in tracks:
-            coro = self.find_song(track=track)
-            coros.append(coro)
+        async def process(profile_image_bytes: bytes) -> dict:
+            profile_image_bytes_resized = await self.image_pool.run(resize_image, profile_image_bytes, 150, 150)
+            profile_image_b64_str = base64.b64encode(profile_image_bytes_resized).decode("utf-8")
+            return {"profile_image": f"data:image/jpeg;base64,{profile_image_b64_str}"}
+
+        processed = await self.get_processed_image(self.avatar_cache, largest_image_url, "150x150", process)
+        return processed["profile_image"]
 
-        matches = await asyncio.gather(*coros)
-        return matches
+    async def get_processed_image(
+        self,
+        cache: Optional[RedisCache],
+        url: str,
+        variant: str,
+        process: Callable[[bytes], Awaitable[dict]],
+    ) -> dict:
+        """Download the image at url and return process(image bytes), cached in cache by url and variant
+
+        Past the freshness window, the image is revalidated with its ETag or Last-Modified date, and only
+        processed again if its content changed.
+        """
+        if cache is None:
+            return await process(await self.async_get(url=url))
+        key = f"{variant}:{url}"
+        cached = await cache.get(key)
+        now = time.time()
+        if cached is not None and now - cached["checked_at"] < self.IMAGE_FRESHNESS:
+            return cached["processed"]
+
+        response = await self.async_get_conditional(
+            url,
+            etag=cached["etag"] if cached is not None else None,
+            last_modified=cached["last_modified"] if cached is not None else None,
+        )
+        content_hash = hashlib.sha256(response.data).hexdigest() if response.modified else None
+        if cached is not None and (not response.modified or content_hash == cached["content_hash"]):
+            processed = cached["processed"]
+            content_hash = cached["content_hash"]
+        else:
+            processed = await process(response.data)
+        await cache.set(
+            key,
+            {
+                "processed": processed,
+                "content_hash": content_hash,
+                "etag": response.etag,
+                "last_modified": response.last_modified,
+                "checked_at": now,
+            },
+        )
+        return processed
+
+    async def iter_song_id_list(self, tracks: AsyncIterable[Track], concurrency: int = None) -> AsyncIterator[Match]:
+        """Yield a Match for each track in tracks order, searching as soon as each track arrives"""
+        async for match in imap(tracks, self.find_song, concurrency or self.MAX_CONCURRENT_REQUESTS):
+            yield match
 
     async def find_song(self, track: Track) -> Match:
         """"""
+        if self.match_cache is not None:
+            key = self._match_cache_key(track)
+            cached_match = await self.match_cache.get(key)
+            if cached_match is not None:
+                return Match(track, cached_match["id"])
+
         query = track.artist + " " + track.title
         query_result = await self.search(query)
         match = await self.find_match(track, query_result)
+
+        if self.match_cache is not None:
+            # Songs not found on Spotify are cached too, for a shorter time
+            cached_match = {"id": match.id}
+            if self.MATCH_CACHE_SEARCH_ITEMS:
+                cached_match["items"] = query_result["tracks"]["items"]
+            ttl = self.MATCH_CACHE_TTL if match.id is not None else self.MATCH_CACHE_NEGATIVE_TTL
+            await self.match_cache.set(key, cached_match, ttl=ttl)
         return match
 
+    def _match_cache_key(self, track: Track) -> str:
+        """"""
+        market = self._user.get("country")
+        return f"{market}:{track.normalized.artist}:{track.normalized.title}"
+
     async def search(self, query: str) -> dict:
         """"""
         token = self._access_token_response.get("access_token", None)
@@ -112,51 +243,30 @@ class Spotify(HttpClient):
         limit = 50 if not self._faster_tests else 5
         market = self._user.get("country")
         params = {"query": query, "type": "track", "market": market, "limit": limit}
-        result = await self.async_get(url=url, access_token=token, params=params)
-        return result
+        result = await self.async_get(url=url, access_token=token, params=params, decoder=SPOTIFY_SEARCH_DECODER)
+        # Only keep the fields used for matching, not the album and market blobs of each item
+        items = [
+            {
+                "id": item.get("id"),
+                "name": item.get("name"),
+                "artists": [{"name": artist.get("name")} for artist in item.get("artists", [])],
+            }
+            for item in result.get("tracks", {}).get("items", [])
+        ]
+        return {"tracks": {"items": items}}
 
     async def find_match(self, track: Track, query_result: json) -> Match:
         """"""
         logging.info(f"Searching for track {repr(track)} on Spotify...")
         items = query_result.get("tracks", {}).get("items", [])
-        for item in items:
-            item_id = item.get("id")
-            item_title = item.get("name")
-            item_artists = item.get("artists", [])
-            for item_artist in item_artists:
-                item_artist_name = item_artist.get("name")
-                item_track = Track(item_artist_name, item_title)
-                if self.tracks_match(track, item_track):
-                    logging.info(f"    -> {repr(track)} * {repr(item_track)}")
-                    return Match(track, item_id)
+        found = TrackMatcher(track).find(items)
+        if found is not None:
+            item_id, item_track = found
+            logging.info(f"    -> {repr(track)} * {repr(item_track)}")
+            return Match(track, item_id)
         logging.info("    No match found :(")
         return Match(track, None)
 
-    def tracks_match(self, track: Track, item_track: Track) -> bool:
-        """"""
-        dis = textdistance.jaccard.normalized_distance
-        overlap = textdistance.overlap.normalized_distance
-
-        artist = normalize_string(track.artist)
-        title = normalize_string(track.title)
-
-        item_artist = normalize_string(item_track.artist)
-        item_title = normalize_string(item_track.title)
-
-        dis_artist = dis(artist, item_artist)
-        dis_title = dis(title, item_title)
-        overlap_artist = overlap(artist, item_artist)
-        overlap_title = overlap(title, item_title)
-
-        match = (overlap_title <= 0.3) & (overlap_artist <= 0.3) & (dis_artist <= 0.3) & (dis_title <= 0.5)
-
-        track_match = (
-            f"    {repr(track)} * {repr(item_track)} : {dis_artist} {dis_title} {overlap_artist} {overlap_title}"
-        )
-        logging.debug(track_match)
-
-        return match
-
     async def get_tracks(self, id: str) -> dict:
         """"""
         token = self._access_token_response.get("access_token", None)
@@ -166,15 +276,21 @@ class Spotify(HttpClient):
         result = await self.async_get(url=url, access_token=token, params=params)
         return result
 
-    async def create_playlist(self, beatmaker_name, playlist_image_url) -> Playlist:
-        """"""
+    async def create_playlist(self, beatmaker_name, playlist_image_url: Optional[str] = None) -> Playlist:
+        """Without playlist_image_url, the playlist is created without cover image"""
         response = await self._create_playlist(beatmaker_name=beatmaker_name)
         playlist_id = response.get("id")
         playlist_name = response.get("name")
         playlist_url = response.get("external_urls", {}).get("spotify", "")
-        playlist_image = await self._upload_cover_image_playlist(playlist_id, playlist_image_url)
         logging.info(f"Playlist created with id {playlist_id}")
-        return Playlist(playlist_id, playlist_name, playlist_url, playlist_image)
+        playlist = Playlist(playlist_id, playlist_name, playlist_url, "")
+        if playlist_image_url is not None:
+            await self.upload_cover_image(playlist, playlist_image_url)
+        return playlist
+
+    async def upload_cover_image(self, playlist: Playlist, playlist_image_url: str) -> None:
+        """Replace the cover image of the playlist, and set its image for frontend"""
+        playlist.image = await self._upload_cover_image_playlist(playlist.id, playlist_image_url)
 
     async def _create_playlist(self, beatmaker_name: str) -> dict:
         """"""
@@ -195,36 +311,82 @@ class Spotify(HttpClient):
         """"""
         logging.info(f"Uploading cover image to playlist {playlist_id}")
 
-        # Download playlist image from Genius.com
-        playlist_image_bytes = await self.async_get(url=playlist_image_url)
+        # Download playlist image from Genius.com, resized to 300x300 with a maximum size of 256 kB for Spotify,
+        # and to 200x200 for frontend
+        async def process(playlist_image_bytes: bytes) -> dict:
+            playlist_image_compressed, playlist_image_bytes_resized = await self.image_pool.run(
+                cover_images, playlist_image_bytes, 256, (300, 300), (200, 200)
+            )
+            return {
+                "upload": base64.b64encode(playlist_image_compressed).decode("utf-8"),
+                "thumbnail": base64.b64encode(playlist_image_bytes_resized).decode("utf-8"),
+            }
 
-        # Upload playlist image to Spotify playlist, resized to 300x300 and with a maximum size of 256 kB
-        playlist_image_compressed = compress_image(playlist_image_bytes, 256, 300, 300)
-        playlist_image_b64 = base64.b64encode(playlist_image_compressed)
+        processed = await self.get_processed_image(
+            self.cover_cache, playlist_image_url, "256kB:300x300:200x200", process
+        )
+
+        # Upload playlist image to Spotify playlist
+        playlist_image_b64 = processed["upload"]
         token = self._access_token_response.get("access_token", None)
         url = f"{self.BASE_URL}/playlists/{playlist_id}/images"
         headers = {"Content-Type": "image/jpeg"}
         await self.async_put(url=url, data=playlist_image_b64, access_token=token, headers=headers)
 
-        # Return playlist image for frontend, resized to 200x200
-        playlist_image_bytes_resized = resize_image(playlist_image_bytes, width=200, height=200)
-        playlist_image_b64_str = base64.b64encode(playlist_image_bytes_resized).decode("utf-8")
-        playlist_image = f"data:image/jpeg;base64,{playlist_image_b64_str}"
+        # Return playlist image for frontend
+        playlist_image = f"data:image/jpeg;base64,{processed['thumbnail']}"
         return playlist_image
 
-    async def add_tracks(self, playlist: Playlist, matches: list[Match]) -> None:
+    async def get_playlist_length(self, playlist: Playlist) -> int:
+        """"""
+        token = self._access_token_response.get("access_token", None)
+        url = f"{self.BASE_URL}/playlists/{playlist.id}"
+        params = {"fields": "tracks.total"}
+        response = await self.async_get(url=url, access_token=token, params=params)
+        return response["tracks"]["total"]
+
+    async def get_playlist_track_ids(self, playlist: Playlist) -> list[str]:
+        """Spotify ids of the tracks of the playlist, in playlist order"""
+        token = self._access_token_response.get("access_token", None)
+        url = f"{self.BASE_URL}/playlists/{playlist.id}/tracks"
+        limit = self.ADD_TRACKS_BATCH_SIZE
+        track_ids = []
+        offset = 0
+        while True:
+            params = {"fields": "items(track(id))", "limit": limit, "offset": offset}
+            response = await self.async_get(url=url, access_token=token, params=params)
+            items = response.get("items", [])
+            track_ids += [item["track"]["id"] for item in items if item.get("track")]
+            if len(items) < limit:
+                return track_ids
+            offset += limit
+
+    async def add_tracks(
+        self, playlist: Playlist, matches: list[Match], start_position: Optional[int] = None
+    ) -> Optional[str]:
+        """Add the matched tracks after the start_position first tracks of the playlist, in matches order
+
+        Batches are sent one after another: each one is inserted at its final position, which is only valid once
+        the previous ones are added. Returns the snapshot id of the last batch.
+        """
         logging.info(f"Adding tracks to playlist {playlist.id}")
         token = self._access_token_response.get("access_token", None)
         url = f"{self.BASE_URL}/playlists/{playlist.id}/tracks"
-        uris = [f"spotify:track:{match.id}" for match in matches if match.id is not None]
-        number_of_batches = math.ceil(len(uris) / 100)  # Spotify limit : 100 items per request
-        for batch in range(number_of_batches):
-            if batch + 1 == number_of_batches:  # Last batch
-                uri_batch = uris[batch * 100 :]
-            else:
-                uri_batch = uris[batch * 100 : (batch + 1) * 100]
-            logging.info(f"    Batch {batch+1}/{number_of_batches}: {len(uri_batch)}")
-            data = {"uris": uri_batch}
+        headers = {"Content-Type": "application/json"}
+        # Remove duplicates, keeping the first occurrence
+        track_ids = list(dict.fromkeys(match.id for match in matches if match.id is not None))
+        if not track_ids:
+            return None
+        if start_position is None:
+            start_position = await self.get_playlist_length(playlist)
+
+        batch_size = self.ADD_TRACKS_BATCH_SIZE
+        batches = [track_ids[start : start + batch_size] for start in range(0, len(track_ids), batch_size)]
+        snapshot_id = None
+        for index, batch in enumerate(batches):
+            logging.info(f"    Batch {index+1}/{len(batches)}: {len(batch)}")
+            data = {"uris": [f"spotify:track:{id}" for id in batch], "position": start_position + index * batch_size}
             data = json.dumps(data, separators=(",", ":"), ensure_ascii=True)
-            headers = {"Content-Type": "application/json"}
-            await self.async_post(url=url, data=data, access_token=token, headers=headers)
+            response = await self.async_post(url=url, data=data, access_token=token, headers=headers)
+            snapshot_id = response.get("snapshot_id")
+        return snapshot_id
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import functools
 import json
 from pathlib import Path
 import re
@@ -7,23 +8,42 @@ import unidecode
 from PIL import Image
 import io
 
+NORMALIZE_CACHE_SIZE = 100_000
+BRACKETS_PATTERN = re.compile(r"[\(\[].*?[\)\]]")
+
 
 class ImageTooBig(Exception):
     """"""
 
 
-@dataclass
+@dataclass(slots=True)
 class Track:
     """"""
 
     artist: str
     title: str
+    _normalized: Optional["NormalizedTrack"] = field(default=None, init=False, repr=False, compare=False)
 
     def __repr__(self):
         return self.artist + " " + self.title
 
+    @property
+    def normalized(self) -> "NormalizedTrack":
+        """Normalized form of the track, computed on first access"""
+        if self._normalized is None:
+            self._normalized = NormalizedTrack(normalize_string(self.artist), normalize_string(self.title))
+        return self._normalized
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
+class NormalizedTrack:
+    """Artist and title as compared when matching tracks"""
+
+    artist: str
+    title: str
+
+
+@dataclass(slots=True)
 class Match:
     """"""
 
@@ -49,10 +69,11 @@ def clean_json_str(string: str):
     return json.dumps(string, ensure_ascii=False).replace('"', "")
 
 
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_string(string: str) -> str:
     """"""
     safe_string = unidecode.unidecode(string).lower()
-    cleaned_string = re.sub(r"[\(\[].*?[\)\]]", "", safe_string)
+    cleaned_string = BRACKETS_PATTERN.sub("", safe_string)
     return cleaned_string
 
 
@@ -66,28 +87,75 @@ def write_json(data: dict, filename: str, directory: str = "debug") -> None:
         json.dump(data, f, ensure_ascii=False, indent=4)
 
 
-def resize_image(bytes: bytes, width, height) -> bytes:
+JPEG_MAX_QUALITY = 95
+JPEG_MIN_QUALITY = 10
+
+
+def _open_image(bytes: bytes, width, height) -> Image.Image:
+    """Decode an image once, as RGB, letting JPEG decoding downscale as long as it stays above width x height
+
+    Transparent areas of PNG and WebP images are filled with white, since JPEG has no alpha channel.
+    """
+    image = Image.open(io.BytesIO(bytes))
+    image.draft("RGB", (width, height))
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _encode_jpeg(image: Image.Image, quality: int) -> bytes:
     """"""
-    playlist_image = Image.open(io.BytesIO(bytes))
-    playlist_image.thumbnail((width, height), Image.Resampling.LANCZOS)
     output_buffer = io.BytesIO()
-    playlist_image.save(output_buffer, format=playlist_image.format, quality=95)
+    image.save(output_buffer, format="JPEG", quality=quality, optimize=True)
     return output_buffer.getvalue()
 
 
+def _encode_jpeg_under(image: Image.Image, target_size_bytes: int) -> bytes:
+    """Encode with the highest quality fitting in target_size_bytes, binary searching it if the maximum does not"""
+    encoded = _encode_jpeg(image, JPEG_MAX_QUALITY)
+    if len(encoded) <= target_size_bytes:
+        return encoded
+    low, high = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY - 1
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = _encode_jpeg(image, quality)
+        if len(encoded) <= target_size_bytes:
+            best = encoded
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        raise ImageTooBig
+    return best
+
+
+def resize_image(bytes: bytes, width, height) -> bytes:
+    """Resize an image to fit in width x height, as a JPEG"""
+    image = _open_image(bytes, width, height)
+    image.thumbnail((width, height), Image.Resampling.LANCZOS)
+    return _encode_jpeg(image, JPEG_MAX_QUALITY)
+
+
 def compress_image(bytes: bytes, target_size_kb: int, max_width, max_height) -> bytes:
-    """"""
-    MAX_QUALITY = 95
-    MIN_QUALITY = 10
-    step = 5
-    target_size_bytes = target_size_kb * 1024
-
-    playlist_image = Image.open(io.BytesIO(bytes))
-    playlist_image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-    for quality in range(MAX_QUALITY, MIN_QUALITY, -step):
-        output_buffer = io.BytesIO()
-        playlist_image.save(output_buffer, format=playlist_image.format, quality=quality, optimize=True)
-        size = output_buffer.tell()
-        if size <= target_size_bytes:
-            return output_buffer.getvalue()
-    raise ImageTooBig
+    """Resize an image to fit in max_width x max_height, as a JPEG of at most target_size_kb"""
+    image = _open_image(bytes, max_width, max_height)
+    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+    return _encode_jpeg_under(image, target_size_kb * 1024)
+
+
+def cover_images(bytes: bytes, target_size_kb: int, upload_size: tuple, thumbnail_size: tuple) -> tuple[bytes, bytes]:
+    """Decode a cover once, and return it compressed for upload and resized as a thumbnail, both as JPEGs
+
+    The thumbnail is derived from the upload size image, which must be the largest.
+    """
+    image = _open_image(bytes, *upload_size)
+    image.thumbnail(upload_size, Image.Resampling.LANCZOS)
+    upload = _encode_jpeg_under(image, target_size_kb * 1024)
+    image.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+    thumbnail = _encode_jpeg(image, JPEG_MAX_QUALITY)
+    return upload, thumbnail
@@ -0,0 +1,196 @@
+import asyncio
+import contextlib
+import logging
+import signal
+import sys
+import aiohttp
+import redis.asyncio as redis
+
+from beatmaker_playlist import BeatmakerPlaylist
+from http_client import HTTPException, BadRequest, Unauthorized, Forbidden, NotFound, SessionPool
+from image_pool import ImagePool
+from jobs import Checkpoint, Job, JobQueue
+from producer_index import ProducerIndex
+from producer_songs import SharedProducerSongs
+import secret_keys
+
+REDIS_MAX_CONNECTIONS = 50
+
+
+class Worker:
+    """Run the jobs of the queue, up to concurrency at once, with the HTTP sessions and images pool of the
+    process"""
+
+    CONCURRENCY = 4
+    POLL_INTERVAL = 0.5
+    REQUEUE_EXPIRED_INTERVAL = 10
+    # BeatmakerPlaylist methods a job can run
+    KINDS = ("make_playlist", "refresh_playlist")
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        client: SessionPool,
+        image_pool: ImagePool,
+        redis_client: redis.Redis,
+        producer_index: ProducerIndex,
+        concurrency: int = None,
+    ):
+        """"""
+        self.queue = queue
+        self._client = client
+        self._image_pool = image_pool
+        self._redis = redis_client
+        self._producer_index = producer_index
+        self._shared_songs = SharedProducerSongs(redis_client)
+        self.concurrency = concurrency or self.CONCURRENCY
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        """Stop taking jobs, the running ones are finished"""
+        self._stopping.set()
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """Network errors, timeouts and server errors may not happen again, client errors will"""
+        if isinstance(error, (BadRequest, Unauthorized, Forbidden, NotFound)):
+            return False
+        return isinstance(error, (HTTPException, aiohttp.ClientError, asyncio.TimeoutError, redis.ConnectionError))
+
+    def _playlist_manager(self, job: Job) -> BeatmakerPlaylist:
+        """"""
+        playlist_manager = BeatmakerPlaylist(
+            client=self._client,
+            user_id=job.user_id,
+            faster_tests=secret_keys.FASTER_TESTS,
+            image_pool=self._image_pool,
+            redis_client=self._redis,
+            shared_songs=self._shared_songs,
+            producer_index=self._producer_index,
+        )
+        playlist_manager.set_spotify_credentials(**job.credentials)
+        return playlist_manager
+
+    async def _keep_visible(self, job: Job, run: asyncio.Task) -> None:
+        """Extend the visibility deadline of the job while it runs, cancelling run if the job was queued again"""
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            try:
+                extended = await self.queue.extend(job)
+            except Exception as e:
+                logging.error(f"Failed to extend job {job.id}: {e}")
+                continue
+            if not extended:
+                logging.warning(f"Job {job.id} was queued again while running, cancelling it")
+                run.cancel()
+                return
+
+    async def _run(self, job: Job) -> None:
+        """"""
+        logging.info(f"Running job {job.id} ({job.kind}, attempt {job.attempts}/{job.max_attempts})")
+        playlist_manager = self._playlist_manager(job)
+        keep_visible = asyncio.create_task(self._keep_visible(job, asyncio.current_task()))
+        try:
+            if job.kind not in self.KINDS:
+                raise ValueError(f"Unknown job kind {job.kind}")
+            run = getattr(playlist_manager, job.kind)
+            # The Spotify writes of the previous attempts are not repeated
+            checkpoint = Checkpoint(job.checkpoint, lambda: self.queue.save_checkpoint(job))
+            await run(**job.args, task_id=job.task_id, report_errors=False, checkpoint=checkpoint)
+        except asyncio.CancelledError:
+            if not keep_visible.done():
+                raise
+            # Another worker runs the job now, it is neither completed nor retried here
+            logging.warning(f"Job {job.id} abandoned")
+        except Exception as e:
+            if self.is_retryable(e) and job.attempts < job.max_attempts:
+                logging.warning(f"Job {job.id} failed, retrying: {e}")
+                await playlist_manager.update_progress(job.task_id, 0, "Retrying after an error")
+                await self.queue.retry(job)
+            else:
+                logging.error(f"Job {job.id} failed: {e}")
+                await playlist_manager.set_error(job.task_id, str(e))
+                await self.queue.complete(job)
+        else:
+            await self.queue.complete(job)
+        finally:
+            keep_visible.cancel()
+            logging.info(f"Job {job.id} requests: {playlist_manager.get_request_stats()}")
+            logging.info(f"Job {job.id} caches: {playlist_manager.get_cache_stats()}")
+
+    async def _requeue_expired(self) -> None:
+        """Queue again the jobs of dead workers, failing the ones without attempts left"""
+        while True:
+            try:
+                expired_jobs = await self.queue.requeue_expired()
+            except Exception as e:
+                logging.error(f"Failed to requeue expired jobs: {e}")
+                expired_jobs = []
+            for job in expired_jobs:
+                logging.error(f"Job {job.id} timed out {job.attempts} times")
+                try:
+                    await self._playlist_manager(job).set_error(job.task_id, "The task timed out")
+                    await self.queue.complete(job)
+                except Exception as e:
+                    logging.error(f"Failed to fail job {job.id}: {e}")
+            await asyncio.sleep(self.REQUEUE_EXPIRED_INTERVAL)
+
+    async def run(self) -> None:
+        """Take and run jobs until stopped"""
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        requeue_expired = asyncio.create_task(self._requeue_expired())
+        try:
+            while not self._stopping.is_set():
+                await slots.acquire()
+                try:
+                    job = await self.queue.claim()
+                except Exception as e:
+                    # The running jobs keep their sessions, the queue is polled again
+                    logging.error(f"Failed to claim a job: {e}")
+                    job = None
+                if job is None:
+                    slots.release()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._stopping.wait(), timeout=self.POLL_INTERVAL)
+                    continue
+                task = asyncio.create_task(self._run(job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+                task.add_done_callback(lambda _: slots.release())
+            if running:
+                logging.info(f"Waiting for {len(running)} running jobs")
+                await asyncio.gather(*running, return_exceptions=True)
+        finally:
+            requeue_expired.cancel()
+
+
+async def main(concurrency: int = None) -> None:
+    """"""
+    redis_pool = redis.BlockingConnectionPool(
+        host=secret_keys.REDIS_HOST,
+        port=secret_keys.REDIS_PORT,
+        db=secret_keys.REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+    )
+    redis_client = redis.Redis.from_pool(redis_pool)
+    client = SessionPool(redis_client=redis_client)
+    image_pool = ImagePool()
+    producer_index = ProducerIndex(redis_client)
+    worker = Worker(JobQueue(redis_client), client, image_pool, redis_client, producer_index, concurrency=concurrency)
+
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        await producer_index.close()
+        await client.close()
+        await redis_client.aclose()
+        image_pool.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="{asctime} - {levelname} - {message}", style="{")
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else None))